@@ -0,0 +1,25 @@
+# Image work for the derivative worker processes. Kept apart from server.py so
+# a worker imports Pillow and nothing else: no Motor client, app or broker.
+from PIL import Image, ImageOps
+from typing import List
+import os
+
+def render_derivatives(source: str, targets: List[tuple], max_pixels: int):
+    with Image.open(source) as image:
+        # Dimensions come from the header, so oversized images are refused before decoding
+        width, height = image.size
+        if width * height > max_pixels:
+            raise ValueError(f"{width}x{height} image exceeds {max_pixels} pixels")
+        
+        # Lets JPEG decode at a reduced scale instead of full resolution
+        largest = max(size for _, size in targets)
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        
+        for path, size in sorted(targets, key=lambda target: -target[1]):
+            image.thumbnail((size, size), Image.LANCZOS)
+            partial = f"{path}.part"
+            image.save(partial, "WEBP", quality=80)
+            os.replace(partial, path)
@@ -1,21 +1,42 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File, Depends, status
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Depends, Query, Request, status
+from fastapi.responses import ORJSONResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set, Union
 import uuid
-from datetime import datetime, timezone
+import asyncio
+import time
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 import json
+import orjson
+import base64
+import hashlib
+import heapq
+import itertools
+import bisect
+import math
+import mimetypes
+import re
 import bcrypt
 import jwt
 from jwt.exceptions import InvalidTokenError
 import aiofiles
 import shutil
+import stat
+import multiprocessing
+from imaging import render_derivatives
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,12 +50,94 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-super-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
 
+# Password hashing pool
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', '4'))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', '32'))
+
 # File upload directory
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', str(10 * 1024 * 1024)))
+# Content-addressed attachment blobs and their garbage collector
+BLOB_DIR = UPLOAD_DIR / "blobs"
+BLOB_GC_INTERVAL = float(os.environ.get('BLOB_GC_INTERVAL', '3600'))
+BLOB_GC_GRACE = float(os.environ.get('BLOB_GC_GRACE', '86400'))
+# Image derivatives, rendered in worker processes; sizes bound the longest edge
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+IMAGE_VARIANTS = {
+    "thumbnail": int(os.environ.get('THUMBNAIL_SIZE', '256')),
+    "preview": int(os.environ.get('PREVIEW_SIZE', '1024')),
+}
+# Larger images are not rendered at all; decoding one costs about 4 bytes per pixel
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', str(25_000_000)))
+# Attachment names never change content, so responses are cacheable forever
+ATTACHMENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+mimetypes.add_type("image/webp", ".webp")
+# Room for the multipart boundaries and part headers around the file itself
+UPLOAD_ENVELOPE_SIZE = 64 * 1024
+
+# WebSocket outbound queues
+WS_QUEUE_SIZE = int(os.environ.get('WS_QUEUE_SIZE', '256'))
+WS_OVERFLOW_POLICY = os.environ.get('WS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest, disconnect
+# Idle sockets get a ping every interval and are reaped after the timeout
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', '25'))
+HEARTBEAT_TIMEOUT = float(os.environ.get('HEARTBEAT_TIMEOUT', '60'))
+# Agent online/offline transitions are written to MongoDB in batches this often
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_MS', '2000')) / 1000
+# A worker that has not renewed its lease for this long is presumed dead and
+# its agents' sockets stop counting towards their presence
+WORKER_LEASE = 3 * HEARTBEAT_INTERVAL
+
+# Throttle for the lightweight session summary feed sent to agents
+SUMMARY_INTERVAL = float(os.environ.get('SUMMARY_INTERVAL_MS', '1000')) / 1000
+# Recent session events kept per session for reconnecting clients
+REPLAY_RING_SIZE = int(os.environ.get('REPLAY_RING_SIZE', '200'))
+REPLAY_SESSIONS = int(os.environ.get('REPLAY_SESSIONS', '10000'))
+RESUME_PAGE_SIZE = int(os.environ.get('RESUME_PAGE_SIZE', '100'))
+# Typing shows as "stop" once no typing frame arrived for this long
+TYPING_WINDOW = float(os.environ.get('TYPING_WINDOW_MS', '3000')) / 1000
+
+# Session state cache on the WebSocket hot path
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '300'))
+
+# Agent profile cache shared by WebSocket handlers and REST auth
+AGENT_CACHE_SIZE = int(os.environ.get('AGENT_CACHE_SIZE', '1000'))
+AGENT_CACHE_TTL = float(os.environ.get('AGENT_CACHE_TTL', '600'))
+
+# Group commit for message writes
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', '100'))
+MESSAGE_BATCH_LATENCY = float(os.environ.get('MESSAGE_BATCH_LATENCY_MS', '5')) / 1000
+
+# Verified JWT cache (entries never outlive the token's exp)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', '3600'))
+
+# Inbound frame limits as kind=rate/burst (tokens per second, bucket size),
+# per connection and per session side (visitor or agents); control covers
+# resume and subscribe frames
+RATE_LIMITS = os.environ.get('RATE_LIMITS', 'message=1/5,typing=2/5,file=0.2/3,control=2/20')
+SESSION_RATE_LIMITS = os.environ.get('SESSION_RATE_LIMITS', 'message=2/10,typing=4/10,file=0.5/5,control=4/40')
+RATE_LIMIT_SESSIONS = int(os.environ.get('RATE_LIMIT_SESSIONS', '10000'))
+
+# Admission control: shed or delay inbound work while the loop or DB is slow
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD_MS', '100')) / 1000
+DB_LATENCY_THRESHOLD = float(os.environ.get('DB_LATENCY_THRESHOLD_MS', '250')) / 1000
+ADMISSION_MAX_DELAY = float(os.environ.get('ADMISSION_MAX_DELAY_MS', '500')) / 1000
+
+# Session routing: waiting sessions go to the least loaded online agent
+AUTO_ASSIGN = os.environ.get('AUTO_ASSIGN', 'true').lower() in ('1', 'true', 'yes')
+AGENT_CAPACITY = int(os.environ.get('AGENT_CAPACITY', '5'))  # concurrent active sessions
+
+# Versions reserved by a worker that died mid-write stop holding /sync back after this long
+CHANGE_RESERVATION_TTL = float(os.environ.get('CHANGE_RESERVATION_TTL', '30'))
+
+# Cross-worker event broker (empty = single process, e.g. redis://localhost:6379/0)
+BROKER_URL = os.environ.get('BROKER_URL', '')
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -78,6 +181,7 @@ class Agent(BaseModel):
     role: str = "agent"
     is_online: bool = False
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    version: int = 0  # change version, see ChangeLog
 
 class AgentResponse(BaseModel):
     id: str
@@ -91,13 +195,36 @@ class ChatSession(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     visitor_id: str
     visitor_name: Optional[str] = None
+    source: Optional[str] = None
     assigned_agent_id: Optional[str] = None
     status: str = "waiting"  # waiting, active, closed
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     last_message: Optional[str] = None
+    last_seq: int = 0  # seq of the newest message
+    # Highest message seq each side ("visitor", "agent") has read
+    read_seq: Dict[str, int] = Field(default_factory=dict)
+    unread_count: int = 0  # visitor messages after read_seq["agent"]
+    version: int = 0  # change version, see ChangeLog
+
+class SessionSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    visitor_name: Optional[str] = None
+    assigned_agent_id: Optional[str] = None
+    status: str
+    updated_at: str
+    last_message: Optional[str] = None
+    last_seq: int = 0
     unread_count: int = 0
 
+SESSION_SUMMARY_PROJECTION = {"_id": 0, **{field: 1 for field in SessionSummary.model_fields}}
+
+class SessionPage(BaseModel):
+    sessions: List[Union[ChatSession, SessionSummary]]  # most recently updated first
+    next_cursor: Optional[str] = None
+    has_more: bool = False
+
 class Message(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -109,88 +236,1751 @@ class Message(BaseModel):
     message_type: str = "text"  # text, image, file
     file_url: Optional[str] = None
     file_name: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    preview_url: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
-    is_read: bool = False
+    seq: Optional[int] = None  # per-session, assigned when the message is committed
 
 class MessageCreate(BaseModel):
     content: str
     message_type: str = "text"
     file_url: Optional[str] = None
     file_name: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    preview_url: Optional[str] = None
+
+class SyncPage(BaseModel):
+    version: int  # pass back as ?since= on the next sync
+    full: bool  # True when this is a snapshot rather than a delta
+    sessions: List[ChatSession]
+    agents: List[AgentResponse]
+    removed: Dict[str, List[str]]  # "sessions"/"agents" -> ids
+    has_more: bool = False
+
+class MessagePage(BaseModel):
+    messages: List[Message]  # newest first
+    next_cursor: Optional[str] = None
+    has_more: bool = False
+
+class DashboardSnapshot(BaseModel):
+    version: int  # pass as /sync?since= for incremental updates
+    sessions: List[ChatSession]  # every open session, most recently updated first
+    closed: Optional[SessionPage] = None  # recently closed; continue with /sessions?status=closed&cursor=
+    agents: List[AgentResponse]
+    unread_total: int  # sum of unread_count over the open sessions
+    session: Optional[ChatSession] = None  # the selected session, if any
+    messages: Optional[MessagePage] = None  # its newest messages
 
 class AssignAgent(BaseModel):
     agent_id: str
 
+# ==================== DATABASE INDEXES ====================
+
+# Indexes backing every hot query shape below. create_indexes is a no-op for
+# indexes that already exist with the same spec, so this is safe on every boot.
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "visitors": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "agents": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("version", ASCENDING)], name="version"),
+        IndexModel([("is_online", ASCENDING)], name="is_online"),
+    ],
+    "chat_sessions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("visitor_id", ASCENDING), ("status", ASCENDING)], name="visitor_status"),
+        IndexModel([("version", ASCENDING)], name="version"),
+        IndexModel(
+            [("status", ASCENDING), ("assigned_agent_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+            name="status_agent_updated_id",
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+            name="status_updated_id",
+        ),
+        IndexModel(
+            [("assigned_agent_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+            name="agent_updated_id",
+        ),
+        IndexModel([("updated_at", DESCENDING), ("id", DESCENDING)], name="updated_id"),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("session_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+            name="session_created_id",
+        ),
+        IndexModel([("session_id", ASCENDING), ("seq", ASCENDING)], name="session_seq"),
+        IndexModel([("file_url", ASCENDING)], name="file_url", sparse=True),
+    ],
+    "tombstones": [
+        IndexModel([("kind", ASCENDING), ("id", ASCENDING)], name="kind_id_unique", unique=True),
+        IndexModel([("version", ASCENDING)], name="version"),
+    ],
+    "counters": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "workers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "change_reservations": [
+        IndexModel([("floor", ASCENDING)], name="floor"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "blobs": [
+        IndexModel([("url", ASCENDING)], name="url_unique", unique=True),
+        IndexModel([("refs", ASCENDING), ("last_uploaded_at", ASCENDING)], name="refs_uploaded"),
+    ],
+}
+
+# (collection, filter, sort) for every query the API issues on a hot path.
+QUERY_SHAPES: List[Dict[str, Any]] = [
+    {"name": "get_session", "collection": "chat_sessions", "filter": {"id": "x"}},
+    {
+        "name": "create_session",
+        "collection": "chat_sessions",
+        "filter": {"visitor_id": "x", "status": {"$in": ["waiting", "active"]}},
+    },
+    {
+        "name": "dashboard_open_sessions",
+        "collection": "chat_sessions",
+        "filter": {"status": {"$in": ["waiting", "active"]}},
+        "sort": [("updated_at", -1), ("id", -1)],
+    },
+    {
+        "name": "routing_waiting_queue",
+        "collection": "chat_sessions",
+        "filter": {"status": "waiting"},
+        "sort": [("created_at", 1)],
+    },
+    {"name": "list_sessions", "collection": "chat_sessions", "filter": {}, "sort": [("updated_at", -1), ("id", -1)]},
+    {
+        "name": "list_sessions_by_status",
+        "collection": "chat_sessions",
+        "filter": {"status": "waiting"},
+        "sort": [("updated_at", -1), ("id", -1)],
+    },
+    {
+        "name": "list_sessions_by_agent",
+        "collection": "chat_sessions",
+        "filter": {"assigned_agent_id": "x"},
+        "sort": [("updated_at", -1), ("id", -1)],
+    },
+    {
+        "name": "list_sessions_by_status_and_agent",
+        "collection": "chat_sessions",
+        "filter": {"status": "active", "assigned_agent_id": "x"},
+        "sort": [("updated_at", -1), ("id", -1)],
+    },
+    {
+        "name": "list_sessions_page",
+        "collection": "chat_sessions",
+        "filter": {"status": "waiting", "$or": [
+            {"updated_at": {"$lt": "x"}},
+            {"updated_at": "x", "id": {"$lt": "x"}}
+        ]},
+        "sort": [("updated_at", -1), ("id", -1)],
+    },
+    {
+        "name": "get_messages",
+        "collection": "messages",
+        "filter": {"session_id": "x"},
+        "sort": [("created_at", -1), ("id", -1)],
+    },
+    {
+        "name": "get_messages_before",
+        "collection": "messages",
+        "filter": {"session_id": "x", "$or": [
+            {"created_at": {"$lt": "x"}},
+            {"created_at": "x", "id": {"$lt": "x"}}
+        ]},
+        "sort": [("created_at", -1), ("id", -1)],
+    },
+    {
+        "name": "count_unread",
+        "collection": "messages",
+        "filter": {"session_id": "x", "sender_type": "visitor", "seq": {"$gt": 0}},
+    },
+    {
+        "name": "resume_messages",
+        "collection": "messages",
+        "filter": {"session_id": "x", "seq": {"$gt": 0}},
+        "sort": [("seq", 1)],
+    },
+    {
+        "name": "agent_assigned_sessions",
+        "collection": "chat_sessions",
+        "filter": {"status": "active", "assigned_agent_id": "x"},
+    },
+    {"name": "get_agent", "collection": "agents", "filter": {"id": "x"}},
+    {"name": "presence_sweep", "collection": "agents", "filter": {"is_online": True}},
+    {"name": "login_agent", "collection": "agents", "filter": {"email": "x"}},
+    {"name": "get_visitor", "collection": "visitors", "filter": {"id": "x"}},
+    {"name": "sync_sessions", "collection": "chat_sessions", "filter": {"version": {"$gt": 0}}, "sort": [("version", 1)]},
+    {"name": "sync_agents", "collection": "agents", "filter": {"version": {"$gt": 0}}, "sort": [("version", 1)]},
+    {"name": "sync_removed", "collection": "tombstones", "filter": {"version": {"$gt": 0}}, "sort": [("version", 1)]},
+    {"name": "sync_reservations", "collection": "change_reservations", "filter": {"expires_at": {"$gt": "x"}}, "sort": [("floor", 1)]},
+    {"name": "blob_referenced", "collection": "messages", "filter": {"file_url": "x"}},
+    {
+        "name": "blob_gc_candidates",
+        "collection": "blobs",
+        "filter": {"refs": {"$lte": 0}, "last_uploaded_at": {"$lt": "x"}},
+    },
+]
+
+# Indexes that earlier versions created and nothing queries any more
+OBSOLETE_INDEXES = {
+    "messages": ["session_is_read"],
+}
+
+# Create every declared index, returning the index names per collection
+async def ensure_indexes() -> Dict[str, List[str]]:
+    for collection, names in OBSOLETE_INDEXES.items():
+        for name in names:
+            try:
+                await db[collection].drop_index(name)
+            except OperationFailure:
+                pass
+    created = {}
+    for collection, indexes in INDEX_SPECS.items():
+        try:
+            created[collection] = await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # A conflicting index (or duplicate data under a unique index) must
+            # not keep the API from starting; verify_query_plans will flag it.
+            logger.error(f"Failed to create indexes on {collection}: {e}")
+            created[collection] = []
+    return created
+
+def _plan_stages(plan: Any) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+# Explain every query shape and report the stages of its winning plan
+async def verify_query_plans() -> List[Dict[str, Any]]:
+    report = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
+
+# ==================== MIGRATIONS ====================
+
+# Backfill message seqs and read watermarks from is_read; runs once before serving traffic
+async def migrate_read_watermarks(batch_size: int = 500) -> int:
+    if await db.migrations.find_one({"id": "read_watermarks"}):
+        return 0
+    migrated = 0
+    async for session in db.chat_sessions.find({"last_seq": {"$exists": False}}, {"_id": 0, "id": 1}):
+        session_id = session["id"]
+        seq = 0
+        first_unread = None
+        unread = 0
+        ops = []
+        messages = db.messages.find(
+            {"session_id": session_id},
+            {"_id": 0, "id": 1, "sender_type": 1, "is_read": 1}
+        ).sort([("created_at", ASCENDING), ("id", ASCENDING)])
+        async for message in messages:
+            seq += 1
+            ops.append(UpdateOne({"id": message["id"]}, {"$set": {"seq": seq}, "$unset": {"is_read": ""}}))
+            if message["sender_type"] == "visitor" and not message.get("is_read", True):
+                first_unread = first_unread or seq
+            if first_unread:
+                unread += message["sender_type"] == "visitor"
+            if len(ops) >= batch_size:
+                await db.messages.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            await db.messages.bulk_write(ops, ordered=False)
+        
+        await db.chat_sessions.update_one(
+            {"id": session_id, "last_seq": {"$exists": False}},
+            {"$set": {
+                "last_seq": seq,
+                "read_seq": {"visitor": seq, "agent": first_unread - 1 if first_unread else seq},
+                "unread_count": unread
+            }}
+        )
+        migrated += 1
+    await db.migrations.update_one(
+        {"id": "read_watermarks"},
+        {"$set": {"completed_at": datetime.now(timezone.utc).isoformat(), "sessions": migrated}},
+        upsert=True
+    )
+    logger.info(f"Migrated read state of {migrated} sessions to watermarks")
+    return migrated
+
+async def migrate_change_versions(batch_size: int = 500) -> int:
+    # Records written before the change log existed get a version, so /sync pages reach them
+    migrated = 0
+    for collection in (db.chat_sessions, db.agents):
+        while True:
+            records = await collection.find(
+                {"version": {"$in": [None, 0]}}, {"_id": 0, "id": 1}
+            ).to_list(batch_size)
+            if not records:
+                break
+            async with change_log.stamp(len(records)) as version:
+                await collection.bulk_write([
+                    UpdateOne({"id": record["id"]}, {"$set": {"version": version + offset}})
+                    for offset, record in enumerate(records)
+                ], ordered=False)
+            migrated += len(records)
+    if migrated:
+        logger.info(f"Assigned change versions to {migrated} sessions and agents")
+    return migrated
+
+# ==================== PAGINATION ====================
+
+# Encode the sort-key values of a boundary document as an opaque cursor
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+# Match documents strictly past (fields) == (values) in lexicographic order
+def keyset_filter(fields: List[str], values: List[Any], op: str) -> Dict[str, Any]:
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {f: v for f, v in zip(fields[:i], values[:i])}
+        clause[field] = {op: values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+# ==================== CHANGE LOG ====================
+
+# Monotonic versions for sessions and agents from one counter document; open reservations in
+# change_reservations hold back what /sync advertises, and deletions leave tombstones
+class ChangeLog:
+    def __init__(self, reservation_ttl: float):
+        self.reservation_ttl = reservation_ttl
+        self.seen = 0  # highest counter value this worker has read; never ahead of the counter
+        self.requests: List[tuple] = []  # (count, future) waiting for the next reservation
+        self.reserving = False
+        self.stamps = 0
+        self.reservations = 0
+    
+    # Reserve count consecutive versions for the writes in the block; yields the first
+    @asynccontextmanager
+    async def stamp(self, count: int = 1):
+        future = asyncio.get_running_loop().create_future()
+        self.requests.append((count, future))
+        self.stamps += 1
+        if not self.reserving:
+            self.reserving = True
+            asyncio.create_task(self._reserve())
+        first, reservation = await future
+        try:
+            yield first
+        finally:
+            reservation["open"] -= 1
+            if not reservation["open"]:
+                await db.change_reservations.delete_one({"id": reservation["id"]})
+    
+    # Concurrent stamps on this worker share one reservation and one counter update
+    async def _reserve(self):
+        try:
+            while self.requests:
+                requests, self.requests = self.requests, []
+                total = sum(count for count, _ in requests)
+                reservation = {"id": str(uuid.uuid4()), "open": 0}
+                try:
+                    # Recorded before the counter moves, with a floor at or below the
+                    # versions it will get, so no worker advertises past them early
+                    await db.change_reservations.insert_one({
+                        "id": reservation["id"],
+                        "floor": self.seen + 1,
+                        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.reservation_ttl)
+                    })
+                    counter = await db.counters.find_one_and_update(
+                        {"id": "sync_version"},
+                        {"$inc": {"value": total}},
+                        projection={"_id": 0, "value": 1},
+                        upsert=True,
+                        return_document=ReturnDocument.AFTER
+                    )
+                except Exception as e:
+                    for _, future in requests:
+                        if not future.done():
+                            future.set_exception(e)
+                    try:
+                        await db.change_reservations.delete_one({"id": reservation["id"]})
+                    except Exception as cleanup_error:
+                        logger.warning(f"Change reservation {reservation['id']} left to expire: {cleanup_error}")
+                    continue
+                self.reservations += 1
+                self.seen = max(self.seen, counter["value"])
+                first = counter["value"] - total + 1
+                for count, future in requests:
+                    if not future.done():
+                        reservation["open"] += 1
+                        future.set_result((first, reservation))
+                    first += count
+                if not reservation["open"]:
+                    await db.change_reservations.delete_one({"id": reservation["id"]})
+        finally:
+            self.reserving = False
+    
+    # The highest version below every write still in flight on any worker
+    async def version(self) -> int:
+        counter = await db.counters.find_one({"id": "sync_version"}, {"_id": 0, "value": 1})
+        current = counter["value"] if counter else 0
+        self.seen = max(self.seen, current)
+        # Read after the counter: a reservation missing here was made after that read
+        oldest = await db.change_reservations.find_one(
+            {"expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"_id": 0, "floor": 1},
+            sort=[("floor", ASCENDING)]
+        )
+        if oldest:
+            current = min(current, oldest["floor"] - 1)
+        return current
+    
+    def stats(self) -> Dict[str, int]:
+        return {"stamps": self.stamps, "reservations": self.reservations, "seen": self.seen}
+    
+    # Record that a session or agent was deleted; call after deleting it
+    async def remove(self, kind: str, record_id: str):
+        async with self.stamp() as version:
+            await db.tombstones.update_one(
+                {"kind": kind, "id": record_id},
+                {"$set": {"version": version}},
+                upsert=True
+            )
+
+change_log = ChangeLog(CHANGE_RESERVATION_TTL)
+
+# ==================== CACHES ====================
+
+# Bounded mapping whose entries expire ttl seconds after their last write
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def peek(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key: str, value: dict, ttl: Optional[float] = None) -> dict:
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+    
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+# Session fields needed to route live traffic, refreshed from every session write
+class SessionStateCache(LRUCache):
+    async def get(self, session_id: str) -> Optional[dict]:
+        state = self.peek(session_id)
+        if state is None:
+            session = await db.chat_sessions.find_one({"id": session_id}, SESSION_SUMMARY_PROJECTION)
+            if session:
+                state = self.put(session_id, session)
+        return state
+    
+    def put(self, session_id: str, session: dict) -> dict:
+        return super().put(session_id, {field: session.get(field) for field in SessionSummary.model_fields})
+
+# Agent records without password hashes, keyed by agent id
+class AgentProfileCache(LRUCache):
+    async def get(self, agent_id: str) -> Optional[dict]:
+        profile = self.peek(agent_id)
+        if profile is None:
+            profile = await db.agents.find_one({"id": agent_id}, {"_id": 0, "password_hash": 0})
+            if profile:
+                self.put(agent_id, profile)
+        return profile
+    
+    def put(self, agent_id: str, agent: dict) -> dict:
+        return super().put(agent_id, {k: v for k, v in agent.items() if k not in ("_id", "password_hash")})
+
+# Verified JWT claims keyed by token digest until exp; logged-out tokens are kept as revoked
+class TokenCache(LRUCache):
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(max_size, ttl)
+        self.by_agent: Dict[str, Set[str]] = {}
+        self.revoked: Dict[str, float] = {}  # digest -> exp
+    
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+    
+    def put_claims(self, digest: str, claims: dict):
+        ttl = min(self.ttl, claims["exp"] - time.time())
+        if ttl <= 0:
+            return
+        self.put(digest, claims, ttl)
+        # Forget digests the LRU has already evicted
+        digests = {d for d in self.by_agent.get(claims["agent_id"], ()) if d in self.entries}
+        digests.add(digest)
+        self.by_agent[claims["agent_id"]] = digests
+    
+    def is_revoked(self, digest: str) -> bool:
+        return digest in self.revoked
+    
+    def revoke(self, digest: str, exp: float):
+        now = time.time()
+        self.revoked = {d: e for d, e in self.revoked.items() if e > now}
+        if exp > now:
+            self.revoked[digest] = exp
+        self.invalidate(digest)
+    
+    def invalidate_agent(self, agent_id: str):
+        for digest in self.by_agent.pop(agent_id, ()):
+            self.invalidate(digest)
+
+session_cache = SessionStateCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+agent_cache = AgentProfileCache(AGENT_CACHE_SIZE, AGENT_CACHE_TTL)
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+# ==================== RATE LIMITING ====================
+
+# Parse "message=1/5,typing=2/5" into {kind: (rate, burst)}
+def parse_rate_limits(spec: str) -> Dict[str, tuple]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        limits[kind.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    # Take one token; returns 0 on success, else seconds until one is available
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+# Token buckets per connection and per session side, one per frame kind (per worker)
+class RateLimiter:
+    def __init__(self, connection_limits: Dict[str, tuple], session_limits: Dict[str, tuple], max_sessions: int):
+        self.connection_limits = connection_limits
+        self.session_limits = session_limits
+        self.sessions = LRUCache(max_sessions, 3600)
+        self.limited: Dict[str, Counter] = {"connection": Counter(), "session": Counter()}
+    
+    def connection_buckets(self) -> Dict[str, TokenBucket]:
+        return {kind: TokenBucket(*limit) for kind, limit in self.connection_limits.items()}
+    
+    # 0 if a frame of this kind may proceed, else the seconds to wait
+    def check(self, kind: str, scope: str, buckets: Optional[Dict[str, TokenBucket]] = None) -> float:
+        bucket = (buckets or {}).get(kind)
+        retry_after = bucket.take() if bucket else 0.0
+        if retry_after:
+            self.limited["connection"][kind] += 1
+            return retry_after
+        if kind in self.session_limits:
+            key = f"{scope}:{kind}"
+            bucket = self.sessions.peek(key)
+            if bucket is None:
+                bucket = self.sessions.put(key, TokenBucket(*self.session_limits[kind]))
+            retry_after = bucket.take()
+            if retry_after:
+                self.limited["session"][kind] += 1
+        return retry_after
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connection_limits": self.connection_limits,
+            "session_limits": self.session_limits,
+            "tracked_sessions": len(self.sessions.entries),
+            "limited": {scope: dict(counts) for scope, counts in self.limited.items()}
+        }
+
+# Sheds or delays inbound work while the event loop or the database lags
+class AdmissionController:
+    def __init__(self, lag_threshold: float, db_threshold: float, max_delay: float, interval: float = 0.25):
+        self.lag_threshold = lag_threshold
+        self.db_threshold = db_threshold
+        self.max_delay = max_delay
+        self.interval = interval
+        self.loop_lag = 0.0
+        self.db_latency = 0.0
+        self.db_observed = False
+        self.monitor: Optional[asyncio.Task] = None
+        self.shed = Counter()
+        self.delayed = 0
+    
+    def observe_db(self, seconds: float):
+        self.db_latency = 0.8 * self.db_latency + 0.2 * seconds
+        self.db_observed = True
+    
+    async def _monitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.loop_lag = 0.8 * self.loop_lag + 0.2 * lag
+            # With messages shed nothing reaches the DB, so let the estimate
+            # decay while idle and probe again.
+            if not self.db_observed:
+                self.db_latency *= 0.8
+            self.db_observed = False
+    
+    def load(self) -> float:
+        return max(self.loop_lag / self.lag_threshold, self.db_latency / self.db_threshold)
+    
+    async def admit(self, kind: str) -> bool:
+        load = self.load()
+        if load < 1:
+            return True
+        if kind == "typing" or load >= 2:
+            self.shed[kind] += 1
+            return False
+        self.delayed += 1
+        await asyncio.sleep(min(self.max_delay, self.loop_lag + self.db_latency))
+        return True
+    
+    def start(self):
+        self.monitor = asyncio.create_task(self._monitor())
+    
+    def stop(self):
+        if self.monitor:
+            self.monitor.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loop_lag_ms": round(self.loop_lag * 1000, 2),
+            "db_latency_ms": round(self.db_latency * 1000, 2),
+            "load": round(self.load(), 3),
+            "delayed": self.delayed,
+            "shed": dict(self.shed)
+        }
+
+rate_limiter = RateLimiter(parse_rate_limits(RATE_LIMITS), parse_rate_limits(SESSION_RATE_LIMITS), RATE_LIMIT_SESSIONS)
+admission = AdmissionController(LOOP_LAG_THRESHOLD, DB_LATENCY_THRESHOLD, ADMISSION_MAX_DELAY)
+
+# ==================== MESSAGE WRITER ====================
+
+# Group commit: one insert_many plus one coalesced update per session for each batch
+class MessageWriter:
+    def __init__(self, max_batch: int, max_latency: float):
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pending: List[tuple] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.commit_lock = asyncio.Lock()
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_seen = 0
+        self.batch_sizes: Dict[str, int] = {}
+    
+    # Persist a message document, setting its seq; returns the updated session state
+    async def write(self, doc: dict) -> Optional[dict]:
+        update = {
+            "$set": {
+                "last_message": doc["content"][:100],
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            },
+            "$inc": {"unread_count": 1 if doc["sender_type"] == "visitor" else 0}
+        }
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((doc, update, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_latency, self._flush)
+        await future
+        
+        # The commit refreshed the cache from the updated session document
+        return await session_cache.get(doc["session_id"])
+    
+    def _flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.create_task(self._commit(batch))
+    
+    async def _commit(self, batch: List[tuple]):
+        # Batches commit one at a time and in order, so a later batch can
+        # never overwrite a session's last_message with an older one.
+        async with self.commit_lock:
+            counts = Counter(doc["session_id"] for doc, _, _ in batch)
+            start = time.perf_counter()
+            failed: Dict[int, Exception] = {}
+            try:
+                # Reserve seq numbers first; last_seq and the counters only
+                # move once the messages are stored. A failed insert leaves a
+                # gap in seq, which readers already tolerate.
+                reserved = await asyncio.gather(*[
+                    db.chat_sessions.find_one_and_update(
+                        {"id": session_id},
+                        [{"$set": {"next_seq": {"$add": [
+                            {"$max": [{"$ifNull": ["$next_seq", 0]}, {"$ifNull": ["$last_seq", 0]}]},
+                            count
+                        ]}}}],
+                        projection={"_id": 0, "id": 1, "next_seq": 1},
+                        return_document=ReturnDocument.AFTER
+                    )
+                    for session_id, count in counts.items()
+                ])
+                next_seq = {
+                    session["id"]: session["next_seq"] - counts[session["id"]]
+                    for session in filter(None, reserved)
+                }
+                for doc, _, _ in batch:
+                    if doc["session_id"] in next_seq:
+                        next_seq[doc["session_id"]] += 1
+                        doc["seq"] = next_seq[doc["session_id"]]
+                
+                try:
+                    await db.messages.insert_many([doc for doc, _, _ in batch], ordered=False)
+                except BulkWriteError as e:
+                    for error in e.details.get("writeErrors", []):
+                        failed[error["index"]] = OperationFailure(error.get("errmsg", "insert failed"))
+                    if len(failed) == len(batch):
+                        raise
+                stored = [(doc, update) for i, (doc, update, _) in enumerate(batch) if i not in failed]
+                
+                # Coalesce the session updates of the stored messages
+                sessions: Dict[str, dict] = {}
+                for doc, update in stored:
+                    merged = sessions.setdefault(doc["session_id"], {"$set": {}, "$inc": {}, "$max": {}})
+                    merged["$set"].update(update["$set"])
+                    merged["$inc"]["unread_count"] = merged["$inc"].get("unread_count", 0) + update["$inc"]["unread_count"]
+                    if "seq" in doc:
+                        merged["$max"]["last_seq"] = doc["seq"]
+                async with change_log.stamp(len(sessions)) as version:
+                    for offset, update in enumerate(sessions.values()):
+                        update["$set"]["version"] = version + offset
+                    updated = await asyncio.gather(*[
+                        db.chat_sessions.find_one_and_update(
+                            {"id": session_id},
+                            update,
+                            projection=SESSION_SUMMARY_PROJECTION,
+                            return_document=ReturnDocument.AFTER
+                        )
+                        for session_id, update in sessions.items()
+                    ])
+                for session in filter(None, updated):
+                    session_cache.put(session["id"], session)
+                await attachment_store.add_references([doc.get("file_url") for doc, _ in stored])
+                admission.observe_db(time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Failed to commit batch of {len(batch)} messages: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            if failed:
+                logger.error(f"Failed to store {len(failed)} of {len(batch)} messages in a batch")
+            self._record(len(batch) - len(failed))
+            for i, (_, _, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if i in failed:
+                    future.set_exception(failed[i])
+                else:
+                    future.set_result(None)
+    
+    def _record(self, size: int):
+        self.batches += 1
+        self.messages += size
+        self.max_batch_seen = max(self.max_batch_seen, size)
+        bucket = next(f"<={b}" for b in (1, 2, 5, 10, 25, 50, 100, float("inf")) if size <= b)
+        self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else 0,
+            "max_batch_size": self.max_batch_seen,
+            "batch_size_histogram": self.batch_sizes
+        }
+
+message_writer = MessageWriter(MESSAGE_BATCH_SIZE, MESSAGE_BATCH_LATENCY)
+
+# ==================== CONNECTIONS ====================
+
+# Serialize an outbound event once so every recipient gets the same frame
+def encode_event(message: dict) -> str:
+    return orjson.dumps(message, default=str).decode("utf-8")
+
+# A WebSocket with a bounded outbound queue drained by its own writer task
+class Connection:
+    def __init__(self, key: str, websocket: WebSocket):
+        self.key = key
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.dropped = 0
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.writer = asyncio.create_task(self._drain())
+    
+    # Queue an encoded frame, applying the overflow policy; False once the connection is evicted
+    def enqueue(self, payload: str) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            if WS_OVERFLOW_POLICY == "disconnect":
+                logger.warning(f"Evicting slow consumer {self.key}: outbound queue full")
+                self.close(status.WS_1013_TRY_AGAIN_LATER)
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"Dropped {self.dropped} queued messages for slow consumer {self.key}")
+        return True
+    
+    async def _drain(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to {self.key}: {e}")
+            self.closed = True
+    
+    # Seconds since the peer last sent a frame
+    def idle(self) -> float:
+        return time.monotonic() - self.last_seen
+    
+    def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.cancel()
+        asyncio.create_task(self._close_socket(code))
+    
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            # Already closed by the peer
+            pass
+
+# ==================== EVENT BROKER ====================
+
+# Routes encoded events to every worker; see ConnectionManager._deliver for the targets
+class Broker:
+    def attach(self, deliver):
+        self.deliver = deliver
+    
+    async def start(self):
+        pass
+    
+    async def stop(self):
+        pass
+    
+    async def publish(self, target: str, key: str, payload: str):
+        raise NotImplementedError
+
+# Delivers straight to this process's connections (single worker)
+class InProcessBroker(Broker):
+    async def publish(self, target: str, key: str, payload: str):
+        self.deliver(target, key, payload)
+
+# Fans events out to every worker over Redis pub/sub, including this one
+class RedisBroker(Broker):
+    channel = "chat:events"
+
+    def __init__(self, url: Optional[str] = None, client: Any = None):
+        if client is None:
+            import redis.asyncio as aioredis
+            client = aioredis.from_url(url)
+        self.client = client
+        self.listener: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        self.listener = asyncio.create_task(self._listen())
+    
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+        await self.client.aclose()
+    
+    async def publish(self, target: str, key: str, payload: str):
+        await self.client.publish(self.channel, f"{target}\n{key}\n{payload}")
+    
+    async def _listen(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                async for item in pubsub.listen():
+                    data = item["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode("utf-8")
+                    target, key, payload = data.split("\n", 2)
+                    self.deliver(target, key, payload)
+            except asyncio.CancelledError:
+                await pubsub.aclose()
+                raise
+            except Exception as e:
+                logger.error(f"Broker subscription failed, resubscribing: {e}")
+                await asyncio.sleep(1)
+
+def create_broker(url: str) -> Broker:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    if url:
+        raise ValueError(f"Unsupported BROKER_URL: {url}")
+    return InProcessBroker()
+
 # ==================== CONNECTION MANAGER ====================
 
+# Agent topics: "session:<id>" for one conversation, "queue" for new and
+# reassigned sessions, "summary" for the throttled session summary feed.
+DEFAULT_AGENT_TOPICS = ("queue", "summary")
+
+def session_topic(session_id: str) -> str:
+    return f"session:{session_id}"
+
+PING_FRAME = encode_event({"type": "ping"})
+
+# online_workers lists the workers holding a socket for the agent, which is
+# online while any of them does; adding or removing a worker is idempotent
+def presence_update(agent_id: str, joined: bool, workers: List[str], version: int) -> UpdateOne:
+    held = {"$ifNull": ["$online_workers", []]}
+    if joined:
+        online_workers = {"$setUnion": [held, workers]}
+    else:
+        online_workers = {"$filter": {
+            "input": held,
+            "as": "worker",
+            "cond": {"$and": [{"$ne": ["$$worker", worker]} for worker in workers]}
+        }}
+    return UpdateOne({"id": agent_id}, [
+        {"$set": {"online_workers": online_workers}},
+        {"$set": {"is_online": {"$gt": [{"$size": "$online_workers"}, 0]}, "version": version}}
+    ])
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, Dict[str, WebSocket]] = {
+    def __init__(self, broker: Optional[Broker] = None):
+        # group -> participant (session or agent id) -> id(websocket) -> connection;
+        # a participant is online while it holds at least one connection
+        self.active_connections: Dict[str, Dict[str, Dict[int, Connection]]] = {
             "visitors": {},
             "agents": {}
         }
+        self.topics: Dict[str, Set[str]] = {}  # topic -> agent ids
+        self.agent_topics: Dict[str, Set[str]] = {}  # agent id -> topics
+        self.pending_summaries: Dict[str, dict] = {}
+        self.summary_flusher: Optional[asyncio.Task] = None
+        # session id -> [(seq, payload)] sorted by seq, least recently used first
+        self.replay: "OrderedDict[str, List[tuple]]" = OrderedDict()
+        self.resumes = {"ring": 0, "database": 0}
+        self.reaper: Optional[asyncio.Task] = None
+        self.reaped = {"visitors": 0, "agents": 0}
+        self.pings = 0
+        # agent id -> latest online state not yet written to the database
+        self.pending_presence: Dict[str, bool] = {}
+        self.presence_flusher: Optional[asyncio.Task] = None
+        self.presence_writes = 0
+        self.presence_updates = 0
+        self.broker = broker or InProcessBroker()
+        self.broker.attach(self._deliver)
+        self.origin = uuid.uuid4().hex  # tells this worker's own broker echoes apart
+    
+    # Add a socket for a participant; True if it is their first on this worker
+    def _register(self, group: str, key: str, websocket: WebSocket) -> bool:
+        connections = self.active_connections[group].setdefault(key, {})
+        connections[id(websocket)] = Connection(f"{group[:-1]} {key}", websocket)
+        return len(connections) == 1
+    
+    # Remove one socket (all of them with None); True once the participant has none left
+    def _unregister(self, group: str, key: str, websocket: Optional[WebSocket]) -> bool:
+        connections = self.active_connections[group].get(key)
+        if not connections:
+            return False
+        if websocket is None:
+            removed = list(connections.values())
+            connections.clear()
+        else:
+            connection = connections.pop(id(websocket), None)
+            if connection is None:
+                return False
+            removed = [connection]
+        for connection in removed:
+            connection.writer.cancel()
+        if connections:
+            return False
+        del self.active_connections[group][key]
+        if group == "agents":
+            self.unsubscribe(key, list(self.agent_topics.get(key, ())))
+        return True
+    
+    def subscribe(self, agent_id: str, topics: List[str]):
+        if agent_id not in self.active_connections["agents"]:
+            return
+        for topic in topics:
+            self.topics.setdefault(topic, set()).add(agent_id)
+            self.agent_topics.setdefault(agent_id, set()).add(topic)
+    
+    def unsubscribe(self, agent_id: str, topics: List[str]):
+        for topic in topics:
+            subscribers = self.topics.get(topic)
+            if subscribers:
+                subscribers.discard(agent_id)
+                if not subscribers:
+                    del self.topics[topic]
+            self.agent_topics.get(agent_id, set()).discard(topic)
+        if not self.agent_topics.get(agent_id):
+            self.agent_topics.pop(agent_id, None)
+    
+    # Fan a frame out to every socket the participant has open on this worker
+    def _send(self, group: str, key: str, payload: str):
+        connections = self.active_connections[group].get(key)
+        if not connections:
+            return
+        for connection in list(connections.values()):
+            if not connection.enqueue(payload):
+                self._drop(group, key, connection)
+    
+    # Forget an evicted connection; an agent left without a socket goes offline
+    def _drop(self, group: str, key: str, connection: Connection):
+        if self._unregister(group, key, connection.websocket) and group == "agents":
+            logger.info(f"Agent disconnected: {key}")
+            router.remove_agent(key)
+            self._presence(key, False)
+    
+    def _presence(self, agent_id: str, is_online: bool):
+        self.pending_presence[agent_id] = is_online
+        if self.presence_flusher is None or self.presence_flusher.done():
+            self.presence_flusher = asyncio.create_task(self._flush_presence())
+    
+    async def _flush_presence(self):
+        # Debounce: transitions within an interval collapse to the latest
+        # state per agent, so a reconnect flap costs at most one write.
+        # pending is re-checked with no await in between, so nothing queued
+        # during a write is stranded.
+        while self.pending_presence:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            await self.flush_presence()
+    
+    # Write all pending online/offline transitions in one batch
+    async def flush_presence(self):
+        pending, self.pending_presence = self.pending_presence, {}
+        if not pending:
+            return
+        try:
+            # Only this worker's membership changes; tabs on other workers keep the agent online
+            async with change_log.stamp(len(pending)) as version:
+                await db.agents.bulk_write([
+                    presence_update(agent_id, is_online, [self.origin], version + offset)
+                    for offset, (agent_id, is_online) in enumerate(pending.items())
+                ], ordered=False)
+            self.presence_writes += 1
+            self.presence_updates += len(pending)
+            await self._publish_presence(list(pending))
+        except Exception as e:
+            logger.error(f"Failed to write presence for {len(pending)} agents: {e}")
+            # Retry with the next batch unless a newer transition superseded it
+            for agent_id, is_online in pending.items():
+                self.pending_presence.setdefault(agent_id, is_online)
+    
+    async def _publish_presence(self, agent_ids: List[str]):
+        agents = await db.agents.find(
+            {"id": {"$in": agent_ids}},
+            {"_id": 0, "password_hash": 0}
+        ).to_list(None)
+        for agent in agents:
+            await self.publish_agent_profile(agent["id"], agent)
+    
+    async def renew_lease(self):
+        await db.workers.update_one(
+            {"id": self.origin},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=WORKER_LEASE)}},
+            upsert=True
+        )
+        # A stall past the lease gets this worker swept as dead; count its agents again
+        held = list(self.active_connections["agents"])
+        if held:
+            lost = await db.agents.find(
+                {"id": {"$in": held}, "online_workers": {"$ne": self.origin}}, {"_id": 0, "id": 1}
+            ).to_list(None)
+            for agent in lost:
+                self._presence(agent["id"], True)
+    
+    async def release_lease(self):
+        await db.workers.delete_one({"id": self.origin})
+    
+    async def sweep_presence(self):
+        # Workers that died without a clean shutdown still count towards presence
+        live = {
+            worker["id"] for worker in await db.workers.find(
+                {"expires_at": {"$gt": datetime.now(timezone.utc)}}, {"_id": 0, "id": 1}
+            ).to_list(None)
+        }
+        agents = await db.agents.find({"is_online": True}, {"_id": 0, "id": 1, "online_workers": 1}).to_list(None)
+        dead = {
+            agent["id"]: [worker for worker in agent.get("online_workers", []) if worker not in live]
+            for agent in agents
+        }
+        dead = {agent_id: workers for agent_id, workers in dead.items() if workers}
+        if not dead:
+            return
+        logger.info(f"Clearing presence of {len(dead)} agents held by dead workers")
+        async with change_log.stamp(len(dead)) as version:
+            await db.agents.bulk_write([
+                presence_update(agent_id, False, workers, version + offset)
+                for offset, (agent_id, workers) in enumerate(dead.items())
+            ], ordered=False)
+        await self._publish_presence(list(dead))
+    
+    # Send to every socket of a participant held by this worker
+    def notify_all(self, group: str, key: str, message: dict):
+        self._send(group, key, encode_event(message))
+    
+    def _reply(self, group: str, key: str, websocket: WebSocket, payload: str):
+        # One socket only: answers to what that tab sent must not reach the others
+        connection = self.active_connections[group].get(key, {}).get(id(websocket))
+        if connection and not connection.enqueue(payload):
+            self._drop(group, key, connection)
+    
+    # Send straight to one socket held by this worker
+    def notify(self, group: str, key: str, websocket: WebSocket, message: dict):
+        self._reply(group, key, websocket, encode_event(message))
+    
+    # Record that the peer is alive; any inbound frame counts
+    def touch(self, group: str, key: str, websocket: WebSocket):
+        connection = self.active_connections[group].get(key, {}).get(id(websocket))
+        if connection:
+            connection.last_seen = time.monotonic()
+    
+    async def _reap(self):
+        # Browsers cannot answer protocol-level pings visibly to the app, so
+        # liveness is an application ping that clients answer with "pong".
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.renew_lease()
+                await self.sweep_presence()
+            except Exception as e:
+                logger.error(f"Presence lease upkeep failed: {e}")
+            for group, participants in self.active_connections.items():
+                for key, connections in list(participants.items()):
+                    for connection in list(connections.values()):
+                        idle = connection.idle()
+                        if idle > HEARTBEAT_TIMEOUT:
+                            logger.info(f"Reaping {connection.key}: silent for {idle:.0f}s")
+                            connection.close(status.WS_1001_GOING_AWAY)
+                            self.reaped[group] += 1
+                            self._drop(group, key, connection)
+                        elif idle >= HEARTBEAT_INTERVAL:
+                            self.pings += 1
+                            if not connection.enqueue(PING_FRAME):
+                                self._drop(group, key, connection)
+    
+    def start_reaper(self):
+        self.reaper = asyncio.create_task(self._reap())
+    
+    def stop_reaper(self):
+        if self.reaper:
+            self.reaper.cancel()
+    
+    def connection_stats(self) -> Dict[str, Any]:
+        return {
+            "visitors": len(self.active_connections["visitors"]),
+            "agents": len(self.active_connections["agents"]),
+            "sockets": {
+                group: sum(len(connections) for connections in participants.values())
+                for group, participants in self.active_connections.items()
+            },
+            "pings": self.pings,
+            "reaped": self.reaped,
+            "presence": {
+                "pending": len(self.pending_presence),
+                "writes": self.presence_writes,
+                "updates": self.presence_updates
+            }
+        }
     
     async def connect_visitor(self, session_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections["visitors"][session_id] = websocket
+        self._register("visitors", session_id, websocket)
+        await session_cache.get(session_id)
         logger.info(f"Visitor connected: {session_id}")
+        position = router.position(session_id)
+        if position:
+            self.notify("visitors", session_id, websocket, {
+                "type": "queue_position",
+                "session_id": session_id,
+                "position": position,
+                "waiting": len(router.waiting)
+            })
     
     async def connect_agent(self, agent_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections["agents"][agent_id] = websocket
+        if not self._register("agents", agent_id, websocket):
+            # Another tab: subscriptions, routing and presence are per agent
+            logger.info(f"Agent connected: {agent_id} (another socket)")
+            return
         logger.info(f"Agent connected: {agent_id}")
+        assigned = await db.chat_sessions.find(
+            {"status": "active", "assigned_agent_id": agent_id},
+            {"_id": 0, "id": 1}
+        ).to_list(None)
+        self.subscribe(agent_id, [*DEFAULT_AGENT_TOPICS, *(session_topic(s["id"]) for s in assigned)])
         # Update agent online status
-        await db.agents.update_one(
-            {"id": agent_id},
-            {"$set": {"is_online": True}}
-        )
+        self._presence(agent_id, True)
+        router.add_agent(agent_id, len(assigned))
     
-    def disconnect_visitor(self, session_id: str):
-        if session_id in self.active_connections["visitors"]:
-            del self.active_connections["visitors"][session_id]
-            logger.info(f"Visitor disconnected: {session_id}")
+    def disconnect_visitor(self, session_id: str, websocket: Optional[WebSocket] = None) -> bool:
+        # True once the visitor's last socket is gone
+        if not self._unregister("visitors", session_id, websocket):
+            return False
+        logger.info(f"Visitor disconnected: {session_id}")
+        return True
     
-    async def disconnect_agent(self, agent_id: str):
-        if agent_id in self.active_connections["agents"]:
-            del self.active_connections["agents"][agent_id]
-            logger.info(f"Agent disconnected: {agent_id}")
-            # Update agent offline status
-            await db.agents.update_one(
+    def disconnect_agent(self, agent_id: str, websocket: Optional[WebSocket] = None) -> bool:
+        # Evicted sockets (slow or silent) already went offline in _drop, and
+        # any other open socket for the same agent keeps it online.
+        if not self._unregister("agents", agent_id, websocket):
+            return False
+        logger.info(f"Agent disconnected: {agent_id}")
+        router.remove_agent(agent_id)
+        # Update agent offline status
+        self._presence(agent_id, False)
+        return True
+    
+    async def set_agent_online(self, agent_id: str, is_online: bool) -> Optional[dict]:
+        # An explicit status holds until the agent's next connect or disconnect;
+        # socket membership is left alone so presence stays countable
+        async with change_log.stamp() as version:
+            agent = await db.agents.find_one_and_update(
                 {"id": agent_id},
-                {"$set": {"is_online": False}}
+                {"$set": {"is_online": is_online, "version": version}},
+                projection={"_id": 0, "password_hash": 0},
+                return_document=ReturnDocument.AFTER
             )
+        if agent:
+            await self.publish_agent_profile(agent_id, agent)
+        return agent
+    
+    def _deliver(self, target: str, key: str, payload: str):
+        if target == "agents":
+            for agent_id in list(self.active_connections["agents"]):
+                self._send("agents", agent_id, payload)
+        elif target == "agent":
+            self._send("agents", key, payload)
+        elif target == "visitor":
+            self._send("visitors", key, payload)
+        elif target == "topic":
+            recipients = set()
+            for topic in key.split(","):
+                recipients.update(self.topics.get(topic, ()))
+            for agent_id in recipients:
+                self._send("agents", agent_id, payload)
+        elif target == "session_event":
+            session_id, _, seq = key.rpartition("/")
+            self._remember(session_id, int(seq), payload)
+            self._send("visitors", session_id, payload)
+            for agent_id in list(self.topics.get(session_topic(session_id), ())):
+                self._send("agents", agent_id, payload)
+        elif target == "summary":
+            self.pending_summaries[key] = session_cache.put(key, orjson.loads(payload))
+            if self.summary_flusher is None or self.summary_flusher.done():
+                self.summary_flusher = asyncio.create_task(self._flush_summaries())
+        elif target == "subscribe":
+            self.subscribe(key, [payload])
+        elif target == "agent_profile":
+            self._apply_agent_profile(key, orjson.loads(payload) if payload else None)
+        elif target == "routing":
+            if payload == "waiting":
+                router.enqueue(key)
+            else:
+                router.dequeue(key)
+        elif target == "load":
+            delta, _, origin = payload.partition("/")
+            if origin != self.origin:
+                router.adjust(key, int(delta))
+        elif target == "token_revoked":
+            token_cache.revoke(key, float(payload))
+    
+    def _remember(self, session_id: str, seq: int, payload: str):
+        ring = self.replay.pop(session_id, [])
+        self.replay[session_id] = ring
+        # Concurrent writers may publish a session's events slightly out of order
+        index = bisect.bisect_left(ring, seq, key=lambda entry: entry[0])
+        if index == len(ring) or ring[index][0] != seq:
+            ring.insert(index, (seq, payload))
+            del ring[:-REPLAY_RING_SIZE]
+        while len(self.replay) > REPLAY_SESSIONS:
+            self.replay.popitem(last=False)
+    
+    # Replay session events after last_seq to one socket, from the ring or the database
+    async def resume(self, group: str, key: str, websocket: WebSocket, session_id: str, last_seq: int):
+        session = await session_cache.get(session_id)
+        if not session:
+            return
+        ring = self.replay.get(session_id, [])
+        head = max(session.get("last_seq") or 0, ring[-1][0] if ring else 0)
+        missed = [(seq, payload) for seq, payload in ring if seq > last_seq]
+        has_more = False
+        
+        if [seq for seq, _ in missed] == list(range(last_seq + 1, head + 1)):
+            self.resumes["ring"] += 1
+            source = "ring"
+        else:
+            if not await admission.admit("control"):
+                self._reply(group, key, websocket, encode_event({"type": "overloaded", "kind": "control", "retry_after": 1.0}))
+                return
+            self.resumes["database"] += 1
+            source = "database"
+            messages = await db.messages.find(
+                {"session_id": session_id, "seq": {"$gt": last_seq}},
+                {"_id": 0}
+            ).sort("seq", ASCENDING).limit(RESUME_PAGE_SIZE + 1).to_list(RESUME_PAGE_SIZE + 1)
+            has_more = len(messages) > RESUME_PAGE_SIZE
+            missed = [(m["seq"], encode_event(self.message_event(m))) for m in messages[:RESUME_PAGE_SIZE]]
+        
+        # Assignment is not replayed, so whoever holds the session travels with the frame;
+        # a visitor that connects after auto-assign learns about its agent here
+        agent = await agent_cache.get(session["assigned_agent_id"]) if session.get("assigned_agent_id") else None
+        
+        for _, payload in missed:
+            self._reply(group, key, websocket, payload)
+        self._reply(group, key, websocket, encode_event({
+            "type": "resumed",
+            "session_id": session_id,
+            "seq": missed[-1][0] if missed else max(last_seq, head),
+            "has_more": has_more,
+            "source": source,
+            "session": session,
+            "agent_name": agent.get("name", "Agent") if agent else None
+        }))
+    
+    @staticmethod
+    def message_event(message: dict) -> dict:
+        return {
+            "type": "new_message",
+            "session_id": message["session_id"],
+            "seq": message.get("seq"),
+            "message": message
+        }
+    
+    def _apply_agent_profile(self, agent_id: str, agent: Optional[dict]):
+        previous = agent_cache.peek(agent_id)
+        if agent is None or (previous and previous.get("role") != agent.get("role")):
+            # Deleted agents and role changes must re-verify every token
+            token_cache.invalidate_agent(agent_id)
+        if agent:
+            agent_cache.put(agent_id, agent)
+        else:
+            agent_cache.invalidate(agent_id)
+    
+    async def _flush_summaries(self):
+        # Trailing-edge throttle: at most one summary frame per interval, with
+        # only the latest state of each session that changed in between.
+        await asyncio.sleep(SUMMARY_INTERVAL)
+        sessions, self.pending_summaries = list(self.pending_summaries.values()), {}
+        self._deliver("topic", "summary", encode_event({"type": "session_summary", "sessions": sessions}))
     
     async def send_to_visitor(self, session_id: str, message: dict):
-        if session_id in self.active_connections["visitors"]:
-            try:
-                await self.active_connections["visitors"][session_id].send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending to visitor {session_id}: {e}")
+        await self.broker.publish("visitor", session_id, encode_event(message))
     
     async def send_to_agent(self, agent_id: str, message: dict):
-        if agent_id in self.active_connections["agents"]:
-            try:
-                await self.active_connections["agents"][agent_id].send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending to agent {agent_id}: {e}")
+        await self.broker.publish("agent", agent_id, encode_event(message))
     
     async def broadcast_to_agents(self, message: dict):
-        for agent_id, websocket in self.active_connections["agents"].items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to agent {agent_id}: {e}")
+        await self.broker.publish("agents", "", encode_event(message))
+    
+    # Send to every agent subscribed to at least one of the topics, once
+    async def publish(self, message: dict, *topics: str):
+        await self.broker.publish("topic", ",".join(topics), encode_event(message))
+    
+    # Deliver a committed message to the visitor and followers, and into every replay ring
+    async def publish_message(self, message: dict):
+        event = encode_event(self.message_event(message))
+        await self.broker.publish("session_event", f"{message['session_id']}/{message['seq']}", event)
+    
+    async def publish_routing(self, session_id: str, waiting: bool):
+        # Keeps every worker's waiting queue (and so its positions) identical
+        await self.broker.publish("routing", session_id, "waiting" if waiting else "done")
+    
+    async def publish_load(self, agent_id: Optional[str], delta: int):
+        # Applied here at once so routing never overshoots; every other worker
+        # holding a socket for the agent applies it from the broker
+        if not agent_id:
+            return
+        router.adjust(agent_id, delta)
+        await self.broker.publish("load", agent_id, f"{delta}/{self.origin}")
+    
+    async def publish_summary(self, session: dict):
+        summary = session_cache.put(session["id"], session)
+        await self.broker.publish("summary", session["id"], encode_event(summary))
+    
+    # Replace (or with None, drop) an agent's cached profile on every worker
+    async def publish_agent_profile(self, agent_id: str, agent: Optional[dict]):
+        if agent:
+            agent = {k: v for k, v in agent.items() if k not in ("_id", "password_hash")}
+        self._apply_agent_profile(agent_id, agent)
+        await self.broker.publish("agent_profile", agent_id, encode_event(agent) if agent else "")
+    
+    async def revoke_token(self, digest: str, exp: float):
+        token_cache.revoke(digest, exp)
+        await self.broker.publish("token_revoked", digest, str(exp))
+    
+    # Subscribe an agent to a topic on whichever worker holds its socket
+    async def subscribe_agent(self, agent_id: str, topic: str):
+        await self.broker.publish("subscribe", agent_id, topic)
+
+manager = ConnectionManager(create_broker(BROKER_URL))
+
+# ==================== TYPING INDICATORS ====================
+
+# Collapses per-keystroke typing frames into start/stop transitions
+class TypingCoalescer:
+    def __init__(self, window: float):
+        self.window = window
+        # (session_id, participant) -> [deadline, timer]
+        self.active: Dict[tuple, list] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.frames = 0
+        self.emitted = 0
+    
+    # Record a typing frame; participant is "visitor" or an agent id
+    async def touch(self, session_id: str, participant: str):
+        self.frames += 1
+        key = (session_id, participant)
+        deadline = time.monotonic() + self.window
+        entry = self.active.get(key)
+        if entry:
+            entry[0] = deadline
+            return
+        loop = asyncio.get_running_loop()
+        self.active[key] = [deadline, loop.call_later(self.window, self._expire, key)]
+        await self._emit(key, "start")
+    
+    async def stop(self, session_id: str, participant: str):
+        entry = self.active.pop((session_id, participant), None)
+        if entry:
+            entry[1].cancel()
+            await self._emit((session_id, participant), "stop")
+    
+    async def stop_participant(self, participant: str):
+        for session_id, who in [key for key in self.active if key[1] == participant]:
+            await self.stop(session_id, who)
+    
+    def _expire(self, key: tuple):
+        entry = self.active.get(key)
+        if not entry:
+            return
+        remaining = entry[0] - time.monotonic()
+        if remaining > 0:
+            entry[1] = asyncio.get_running_loop().call_later(remaining, self._expire, key)
+            return
+        del self.active[key]
+        task = asyncio.create_task(self._emit(key, "stop"))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _emit(self, key: tuple, state: str):
+        session_id, participant = key
+        self.emitted += 1
+        try:
+            if participant == "visitor":
+                await manager.publish({
+                    "type": "visitor_typing",
+                    "session_id": session_id,
+                    "state": state
+                }, session_topic(session_id))
+            else:
+                await manager.send_to_visitor(session_id, {
+                    "type": "agent_typing",
+                    "session_id": session_id,
+                    "agent_id": participant,
+                    "state": state
+                })
+        except Exception as e:
+            logger.warning(f"Failed to send typing {state} for session {session_id}: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": int(self.window * 1000),
+            "active": len(self.active),
+            "frames": self.frames,
+            "emitted": self.emitted
+        }
+
+typing_indicator = TypingCoalescer(TYPING_WINDOW)
 
-manager = ConnectionManager()
+# ==================== SESSION ROUTING ====================
+
+# Hands waiting sessions to the least loaded agent connected to this worker
+class SessionRouter:
+    def __init__(self, capacity: int, enabled: bool = True):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.heap: List[list] = []
+        # agent_id -> live heap entry [load, order, agent_id]
+        self.entries: Dict[str, list] = {}
+        self.order = itertools.count()
+        # session_id -> monotonic time it started waiting
+        self.waiting: OrderedDict = OrderedDict()
+        self.drainer: Optional[asyncio.Task] = None
+        self.pending = False
+        self.announcing = False
+        self.assigned = 0
+        self.recent: deque = deque(maxlen=10000)  # monotonic assignment times
+        self.waits: deque = deque(maxlen=1000)  # seconds from enqueue to assignment
+    
+    def _push(self, agent_id: str, load: int):
+        entry = self.entries.get(agent_id)
+        if entry:
+            entry[2] = None
+        entry = [load, next(self.order), agent_id]
+        self.entries[agent_id] = entry
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [e for e in self.heap if e[2] is not None]
+            heapq.heapify(self.heap)
+    
+    def _least_loaded(self) -> Optional[str]:
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if self.heap and self.heap[0][0] < self.capacity:
+            return self.heap[0][2]
+        return None
+    
+    def add_agent(self, agent_id: str, load: int):
+        self._push(agent_id, load)
+        self._kick()
+    
+    def remove_agent(self, agent_id: str):
+        entry = self.entries.pop(agent_id, None)
+        if entry:
+            entry[2] = None
+    
+    # Change an agent's active-session count; freed capacity drains the queue
+    def adjust(self, agent_id: Optional[str], delta: int):
+        entry = self.entries.get(agent_id)
+        if not entry:
+            return
+        self._push(agent_id, max(0, entry[0] + delta))
+        if delta < 0:
+            self._kick()
+    
+    def enqueue(self, session_id: str, waited: float = 0.0):
+        if session_id not in self.waiting:
+            self.waiting[session_id] = time.monotonic() - waited
+            self._kick()
+    
+    def dequeue(self, session_id: str, assigned: bool = False):
+        enqueued = self.waiting.pop(session_id, None)
+        if enqueued is None:
+            return
+        if assigned:
+            now = time.monotonic()
+            self.assigned += 1
+            self.recent.append(now)
+            self.waits.append(now - enqueued)
+        # The head moved: tell the visitors behind it, once per burst
+        if not self.announcing:
+            self.announcing = True
+            asyncio.get_running_loop().call_soon(self.announce)
+    
+    def position(self, session_id: str) -> Optional[int]:
+        for position, waiting_id in enumerate(self.waiting, 1):
+            if waiting_id == session_id:
+                return position
+        return None
+    
+    def _kick(self):
+        if not self.enabled:
+            return
+        self.pending = True
+        if self.drainer is None or self.drainer.done():
+            self.drainer = asyncio.create_task(self._drain())
+    
+    async def _drain(self):
+        # pending is re-checked with no await in between, so a kick that
+        # lands while this task is finishing is never lost
+        while self.pending:
+            self.pending = False
+            moved = False
+            while self.waiting:
+                agent_id = self._least_loaded()
+                if agent_id is None:
+                    break
+                session_id = next(iter(self.waiting))
+                try:
+                    agent = await agent_cache.get(agent_id)
+                    if not agent:
+                        self.remove_agent(agent_id)
+                        continue
+                    await assign_session_to(session_id, agent, only_waiting=True)
+                except Exception as e:
+                    logger.error(f"Routing session {session_id} to {agent_id} failed: {e}")
+                    break
+                # Assigned here or elsewhere, it no longer waits
+                self.dequeue(session_id)
+    
+    def announce(self):
+        # Every worker holds the whole queue, so each one only tells its own visitors
+        self.announcing = False
+        total = len(self.waiting)
+        visitors = manager.active_connections["visitors"]
+        for position, session_id in enumerate(self.waiting, 1):
+            if session_id in visitors:
+                manager.notify_all("visitors", session_id, {
+                    "type": "queue_position",
+                    "session_id": session_id,
+                    "position": position,
+                    "waiting": total
+                })
+    
+    # Rebuild the queue from the database after a restart
+    async def restore(self):
+        sessions = await db.chat_sessions.find(
+            {"status": "waiting"}, {"_id": 0, "id": 1, "created_at": 1}
+        ).sort("created_at", ASCENDING).to_list(None)
+        now = datetime.now(timezone.utc)
+        for session in sessions:
+            waited = (now - datetime.fromisoformat(session["created_at"])).total_seconds()
+            self.enqueue(session["id"], max(0.0, waited))
+    
+    def stop(self):
+        if self.drainer:
+            self.drainer.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        waits = sorted(self.waits)
+        loads = [entry[0] for entry in self.entries.values()]
+        return {
+            "enabled": self.enabled,
+            "capacity": self.capacity,
+            "agents": len(self.entries),
+            "free_slots": sum(max(0, self.capacity - load) for load in loads),
+            "waiting": len(self.waiting),
+            "oldest_wait_s": round(now - next(iter(self.waiting.values())), 1) if self.waiting else 0,
+            "assigned": self.assigned,
+            "assigned_last_min": len(self.recent) - bisect.bisect_left(self.recent, now - 60),
+            "wait_avg_s": round(sum(waits) / len(waits), 2) if waits else 0,
+            "wait_p95_s": round(waits[int(len(waits) * 0.95)], 2) if waits else 0
+        }
+
+router = SessionRouter(AGENT_CAPACITY, AUTO_ASSIGN)
 
 # ==================== AUTH HELPERS ====================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
+    if not hashed:
+        return False
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+# Runs bcrypt on a bounded thread pool; rejects with 503 once queue_limit calls are waiting
+class PasswordHasher:
+    def __init__(self, workers: int, queue_limit: int, rounds: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.queue_limit = queue_limit
+        self.rounds = rounds
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+    
+    async def _run(self, func, *args):
+        if self.in_flight >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many concurrent logins, please retry",
+                headers={"Retry-After": "1"}
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password, self.rounds)
+    
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+    
+    def needs_rehash(self, hashed: str) -> bool:
+        # bcrypt hashes look like $2b$<cost>$<salt+digest>
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rounds": self.rounds,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_LIMIT, BCRYPT_ROUNDS)
+
 def create_token(agent_id: str, email: str) -> str:
     payload = {
         "agent_id": agent_id,
@@ -200,12 +1990,17 @@ def create_token(agent_id: str, email: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 async def get_current_agent(token: str) -> Optional[dict]:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        agent = await db.agents.find_one({"id": payload["agent_id"]}, {"_id": 0, "password_hash": 0})
-        return agent
-    except InvalidTokenError:
+    digest = token_cache.digest(token)
+    if token_cache.is_revoked(digest):
         return None
+    claims = token_cache.peek(digest)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except InvalidTokenError:
+            return None
+        token_cache.put_claims(digest, claims)
+    return await agent_cache.get(claims["agent_id"])
 
 # ==================== VISITOR ENDPOINTS ====================
 
@@ -238,19 +2033,25 @@ async def create_session(visitor_id: str, visitor_name: Optional[str] = None):
     if existing:
         return ChatSession(**existing)
     
+    visitor = await db.visitors.find_one({"id": visitor_id}, {"_id": 0, "source": 1})
     session = ChatSession(
         visitor_id=visitor_id,
         visitor_name=visitor_name,
+        source=visitor.get("source") if visitor else None,
         status="waiting"
     )
-    doc = session.model_dump()
-    await db.chat_sessions.insert_one(doc)
+    async with change_log.stamp() as version:
+        session.version = version
+        doc = session.model_dump()
+        await db.chat_sessions.insert_one(doc)
+    doc.pop('_id', None)
     
-    # Notify all agents about new session
-    await manager.broadcast_to_agents({
+    # Notify agents watching the queue about the new session
+    await manager.publish({
         "type": "new_session",
         "session": doc
-    })
+    }, "queue")
+    await manager.publish_routing(session.id, True)
     
     return session
 
@@ -261,90 +2062,196 @@ async def get_session(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
-@api_router.get("/sessions", response_model=List[ChatSession])
-async def get_all_sessions(status: Optional[str] = None, agent_id: Optional[str] = None):
-    query = {}
+@api_router.get("/sessions", response_model=SessionPage)
+async def get_all_sessions(
+    status: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    source: Optional[str] = None,
+    updated_since: Optional[str] = None,
+    compact: bool = False,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None
+):
+    query: Dict[str, Any] = {}
     if status:
         query["status"] = status
     if agent_id:
         query["assigned_agent_id"] = agent_id
+    if source:
+        query["source"] = source
+    if updated_since:
+        query["updated_at"] = {"$gte": updated_since}
+    if cursor:
+        keys = ["updated_at", "id"]
+        query.update(keyset_filter(keys, decode_cursor(cursor, len(keys)), "$lt"))
     
-    sessions = await db.chat_sessions.find(query, {"_id": 0}).sort("updated_at", -1).to_list(100)
-    return sessions
-
-@api_router.put("/sessions/{session_id}/assign", response_model=ChatSession)
-async def assign_session(session_id: str, assign_data: AssignAgent):
-    agent = await db.agents.find_one({"id": assign_data.agent_id}, {"_id": 0})
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agent not found")
+    projection = SESSION_SUMMARY_PROJECTION if compact else {"_id": 0}
+    sessions = await db.chat_sessions.find(query, projection).sort(
+        [("updated_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
     
-    result = await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {
-            "assigned_agent_id": assign_data.agent_id,
-            "status": "active",
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
+    has_more = len(sessions) > limit
+    sessions = sessions[:limit]
+    next_cursor = None
+    if has_more:
+        edge = sessions[-1]
+        next_cursor = encode_cursor(edge["updated_at"], edge["id"])
+    
+    model = SessionSummary if compact else ChatSession
+    return SessionPage(
+        sessions=[model(**s) for s in sessions],
+        next_cursor=next_cursor,
+        has_more=has_more
     )
+
+@api_router.get("/sessions/{session_id}/queue")
+async def get_queue_position(session_id: str):
+    position = router.position(session_id)
+    if position is None:
+        raise HTTPException(status_code=404, detail="Session is not waiting")
+    return {"position": position, "waiting": len(router.waiting)}
+
+# Assign a session and notify everyone; None if it does not exist or no longer waits
+async def assign_session_to(session_id: str, agent: dict, only_waiting: bool = False) -> Optional[dict]:
+    query: Dict[str, Any] = {"id": session_id}
+    if only_waiting:
+        query["status"] = "waiting"
+    async with change_log.stamp() as version:
+        changes = {
+            "assigned_agent_id": agent["id"],
+            "status": "active",
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "version": version
+        }
+        previous = await db.chat_sessions.find_one_and_update(
+            query,
+            {"$set": changes},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Session not found")
+    if not previous:
+        return None
+    session = {**previous, **changes}
     
-    session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
+    # Keep routing loads in step with who holds which session
+    if previous.get("status") == "active":
+        await manager.publish_load(previous.get("assigned_agent_id"), -1)
+    await manager.publish_load(agent["id"], 1)
+    router.dequeue(session_id, assigned=True)
+    if previous.get("status") == "waiting":
+        await manager.publish_routing(session_id, False)
     
     # Notify visitor that agent joined
     await manager.send_to_visitor(session_id, {
         "type": "agent_joined",
+        "seq": session.get("last_seq", 0),
         "agent_name": agent.get("name", "Agent"),
         "session": session
     })
     
-    # Notify all agents about session update
-    await manager.broadcast_to_agents({
+    # The assigned agent follows the conversation from now on
+    await manager.subscribe_agent(agent["id"], session_topic(session_id))
+    
+    # Notify agents watching the queue or the session about the update
+    await manager.publish({
         "type": "session_updated",
+        "seq": session.get("last_seq", 0),
         "session": session
-    })
+    }, "queue", session_topic(session_id))
+    await manager.publish_summary(session)
+    return session
+
+@api_router.put("/sessions/{session_id}/assign", response_model=ChatSession)
+async def assign_session(session_id: str, assign_data: AssignAgent):
+    agent = await agent_cache.get(assign_data.agent_id)
+    if not agent:
+        raise HTTPException(status_code=404, detail="Agent not found")
+    
+    session = await assign_session_to(session_id, agent)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
     
     return ChatSession(**session)
 
 @api_router.put("/sessions/{session_id}/close", response_model=ChatSession)
 async def close_session(session_id: str):
-    result = await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {
+    async with change_log.stamp() as version:
+        changes = {
             "status": "closed",
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "version": version
+        }
+        previous = await db.chat_sessions.find_one_and_update(
+            {"id": session_id},
+            {"$set": changes},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
     
-    if result.modified_count == 0:
+    if not previous:
         raise HTTPException(status_code=404, detail="Session not found")
+    session = {**previous, **changes}
     
-    session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
+    # A closed session frees its agent's slot or its place in the queue
+    if previous.get("status") == "active":
+        await manager.publish_load(previous.get("assigned_agent_id"), -1)
+    elif previous.get("status") == "waiting":
+        await manager.publish_routing(session_id, False)
     
     # Notify visitor
     await manager.send_to_visitor(session_id, {
         "type": "session_closed",
+        "seq": session.get("last_seq", 0),
         "session": session
     })
     
     # Notify agents
-    await manager.broadcast_to_agents({
+    await manager.publish({
         "type": "session_closed",
+        "seq": session.get("last_seq", 0),
         "session": session
-    })
+    }, "queue", session_topic(session_id))
+    await manager.publish_summary(session)
     
     return ChatSession(**session)
 
 # ==================== MESSAGE ENDPOINTS ====================
 
-@api_router.get("/sessions/{session_id}/messages", response_model=List[Message])
-async def get_messages(session_id: str, limit: int = 50):
-    messages = await db.messages.find(
-        {"session_id": session_id},
-        {"_id": 0}
-    ).sort("created_at", 1).to_list(limit)
-    return messages
+@api_router.get("/sessions/{session_id}/messages", response_model=MessagePage)
+async def get_messages(
+    session_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
+    # Keyset over (session_id, created_at, id): every page is a bounded index
+    # range scan, however long the conversation is.
+    keys = ["created_at", "id"]
+    query: Dict[str, Any] = {"session_id": session_id}
+    if before:
+        query.update(keyset_filter(keys, decode_cursor(before, len(keys)), "$lt"))
+    elif after:
+        query.update(keyset_filter(keys, decode_cursor(after, len(keys)), "$gt"))
+    
+    direction = 1 if after else -1
+    messages = await db.messages.find(query, {"_id": 0}).sort(
+        [("created_at", direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = None
+    if has_more:
+        edge = messages[-1]
+        next_cursor = encode_cursor(edge["created_at"], edge["id"])
+    if after:
+        messages.reverse()
+    
+    return MessagePage(messages=messages, next_cursor=next_cursor, has_more=has_more)
 
 @api_router.post("/sessions/{session_id}/messages", response_model=Message)
 async def create_message(
@@ -354,10 +2261,24 @@ async def create_message(
     sender_id: str,
     sender_name: Optional[str] = None
 ):
-    session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
-    if not session:
+    if not await session_cache.get(session_id):
         raise HTTPException(status_code=404, detail="Session not found")
     
+    kind = "file" if message_data.file_url else "message"
+    retry_after = rate_limiter.check(kind, f"{session_id}/{sender_type}")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many messages",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    if not await admission.admit(kind):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is overloaded",
+            headers={"Retry-After": "1"}
+        )
+    
     message = Message(
         session_id=session_id,
         sender_type=sender_type,
@@ -366,35 +2287,78 @@ async def create_message(
         content=message_data.content,
         message_type=message_data.message_type,
         file_url=message_data.file_url,
-        file_name=message_data.file_name
+        file_name=message_data.file_name,
+        thumbnail_url=message_data.thumbnail_url,
+        preview_url=message_data.preview_url
     )
     
+    # Store the message and update the session in the next group commit
     doc = message.model_dump()
-    await db.messages.insert_one(doc)
-    
-    # Update session
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {
-            "last_message": message_data.content[:100],
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        },
-        "$inc": {"unread_count": 1 if sender_type == "visitor" else 0}}
-    )
+    session = await message_writer.write(doc)
+    doc.pop('_id', None)
+    message.seq = doc.get("seq")
+    if session:
+        await manager.publish_message(doc)
+        await manager.publish_summary(session)
     
     return message
 
+# Re-derive unread_count from the agent watermark
+async def recount_unread(session: dict) -> dict:
+    for _ in range(3):
+        watermark = session.get("read_seq", {}).get("agent", 0)
+        unread = await db.messages.count_documents(
+            {"session_id": session["id"], "sender_type": "visitor", "seq": {"$gt": watermark}}
+        )
+        # Only applies if no message or read landed since the count
+        async with change_log.stamp() as version:
+            updated = await db.chat_sessions.find_one_and_update(
+                {"id": session["id"], "last_seq": session.get("last_seq", 0), "read_seq.agent": watermark},
+                {"$set": {"unread_count": unread, "version": version}},
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+        if updated:
+            return updated
+        session = await db.chat_sessions.find_one({"id": session["id"]}, {"_id": 0})
+    return session
+
+# Advance a participant's read watermark, by default to the newest message
 @api_router.put("/sessions/{session_id}/read")
-async def mark_messages_read(session_id: str):
-    await db.messages.update_many(
-        {"session_id": session_id, "is_read": False},
-        {"$set": {"is_read": True}}
-    )
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {"unread_count": 0}}
-    )
-    return {"status": "ok"}
+async def mark_messages_read(
+    session_id: str,
+    participant: str = "agent",
+    seq: Optional[int] = Query(None, ge=0)
+):
+    if participant not in ("agent", "visitor"):
+        raise HTTPException(status_code=400, detail="participant must be 'agent' or 'visitor'")
+    field = f"read_seq.{participant}"
+    
+    # Single-document write: the watermark only moves forward and never
+    # past last_seq, so a bogus seq cannot mark future messages read
+    last_seq = {"$ifNull": ["$last_seq", 0]}
+    target = last_seq if seq is None else {"$min": [seq, last_seq]}
+    async with change_log.stamp() as version:
+        stage = {
+            field: {"$max": [{"$ifNull": [f"${field}", 0]}, target]},
+            "version": version
+        }
+        if seq is None and participant == "agent":
+            stage["unread_count"] = 0
+        session = await db.chat_sessions.find_one_and_update(
+            {"id": session_id},
+            [{"$set": stage}],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    if seq is not None and participant == "agent":
+        session = await recount_unread(session)
+    
+    await manager.publish_summary(session)
+    return {"status": "ok", "read_seq": session.get("read_seq", {}), "unread_count": session.get("unread_count", 0)}
 
 # ==================== AGENT ENDPOINTS ====================
 
@@ -412,9 +2376,11 @@ async def register_agent(agent_data: AgentCreate):
     )
     
     doc = agent.model_dump()
-    doc["password_hash"] = hash_password(agent_data.password)
+    doc["password_hash"] = await password_hasher.hash(agent_data.password)
     
-    await db.agents.insert_one(doc)
+    async with change_log.stamp() as version:
+        doc["version"] = version
+        await db.agents.insert_one(doc)
     
     return AgentResponse(**agent.model_dump())
 
@@ -424,10 +2390,23 @@ async def login_agent(login_data: AgentLogin):
     if not agent:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(login_data.password, agent.get("password_hash", "")):
+    password_hash = agent.get("password_hash", "")
+    if not await password_hasher.verify(login_data.password, password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade hashes made with a different cost factor while we have the password
+    if password_hasher.needs_rehash(password_hash):
+        try:
+            await db.agents.update_one(
+                {"id": agent["id"]},
+                {"$set": {"password_hash": await password_hasher.hash(login_data.password)}}
+            )
+        except HTTPException:
+            # Pool is saturated; the next login will retry the upgrade
+            pass
+    
     token = create_token(agent["id"], agent["email"])
+    agent_cache.put(agent["id"], agent)
     
     return {
         "token": token,
@@ -440,6 +2419,15 @@ async def login_agent(login_data: AgentLogin):
         }
     }
 
+@api_router.post("/agents/logout")
+async def logout_agent(token: str):
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except InvalidTokenError:
+        return {"status": "ok"}
+    await manager.revoke_token(token_cache.digest(token), claims["exp"])
+    return {"status": "ok"}
+
 @api_router.get("/agents/me", response_model=AgentResponse)
 async def get_current_agent_info(token: str):
     agent = await get_current_agent(token)
@@ -452,55 +2440,544 @@ async def get_all_agents():
     agents = await db.agents.find({}, {"_id": 0, "password_hash": 0}).to_list(100)
     return agents
 
+# Sessions and agents changed after since (since=0 is a snapshot); 304 when nothing changed
+@api_router.get("/sync", response_model=SyncPage, responses={304: {"description": "Nothing changed"}})
+async def sync(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(200, ge=1, le=1000)
+):
+    version = await change_log.version()
+    etag = f'"sync-{version}"'
+    if since and (since >= version or request.headers.get("if-none-match") == etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    # A snapshot is the delta from version 0, paged the same way; deletions
+    # only matter to clients that already hold records
+    window = {"version": {"$gt": since, "$lte": version}}
+    queries = [
+        db.chat_sessions.find(window, {"_id": 0}).sort("version", ASCENDING).to_list(limit + 1),
+        db.agents.find(window, {"_id": 0, "password_hash": 0}).sort("version", ASCENDING).to_list(limit + 1),
+    ]
+    if since:
+        queries.append(db.tombstones.find(window, {"_id": 0}).sort("version", ASCENDING).to_list(limit + 1))
+    sessions, agents, *tombstones = await asyncio.gather(*queries)
+    removed = tombstones[0] if tombstones else []
+    
+    # A truncated list caps the version handed back; the rest comes next page
+    truncated = [records[limit - 1]["version"] for records in (sessions, agents, removed) if len(records) > limit]
+    page = SyncPage(
+        version=min(truncated, default=version),
+        full=since == 0,
+        sessions=sessions[:limit],
+        agents=agents[:limit],
+        removed={
+            kind: [r["id"] for r in removed[:limit] if r["kind"] == kind]
+            for kind in ("sessions", "agents")
+        },
+        has_more=bool(truncated)
+    )
+    return ORJSONResponse(page.model_dump(), headers={"ETag": f'"sync-{page.version}"'})
+
 @api_router.put("/agents/{agent_id}/status")
 async def update_agent_status(agent_id: str, is_online: bool):
-    result = await db.agents.update_one(
-        {"id": agent_id},
-        {"$set": {"is_online": is_online}}
-    )
-    if result.modified_count == 0:
+    if not await manager.set_agent_online(agent_id, is_online):
         raise HTTPException(status_code=404, detail="Agent not found")
     return {"status": "ok"}
 
+# ==================== DASHBOARD ENDPOINTS ====================
+
+# Everything the agent dashboard needs in one round trip
+@api_router.get("/dashboard/snapshot", response_model=DashboardSnapshot)
+async def dashboard_snapshot(
+    session_id: Optional[str] = None,
+    closed: int = Query(0, ge=0, le=200),
+    tail: int = Query(50, ge=1, le=200)
+):
+    version = await change_log.version()
+    
+    # Open sessions come in full so none is hidden and unread_total is exact;
+    # closed ones are history, paged like /sessions
+    queries = {
+        "sessions": db.chat_sessions.find({"status": {"$in": ["waiting", "active"]}}, {"_id": 0}).sort(
+            [("updated_at", DESCENDING), ("id", DESCENDING)]
+        ).to_list(None),
+        "agents": db.agents.find({}, {"_id": 0, "password_hash": 0}).to_list(None),
+    }
+    if closed:
+        queries["closed"] = get_all_sessions(
+            status="closed", agent_id=None, source=None, updated_since=None,
+            compact=False, limit=closed, cursor=None
+        )
+    if session_id:
+        queries["session"] = db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
+        queries["messages"] = get_messages(session_id, limit=tail, before=None, after=None)
+    results = dict(zip(queries, await asyncio.gather(*queries.values())))
+    
+    if session_id and not results["session"]:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    return DashboardSnapshot(
+        version=version,
+        unread_total=sum(s.get("unread_count", 0) for s in results["sessions"]),
+        **results
+    )
+
 # ==================== FILE UPLOAD ====================
 
-@api_router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    # Validate file size (max 10MB)
-    MAX_SIZE = 10 * 1024 * 1024
-    content = await file.read()
-    if len(content) > MAX_SIZE:
-        raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+def upload_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"File too large (max {MAX_UPLOAD_SIZE // (1024 * 1024)}MB)"
+    )
+
+# Stream the "file" part of a multipart body to a temp file, hashing it on the way
+async def receive_upload(request: Request) -> Dict[str, Any]:
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > MAX_UPLOAD_SIZE + UPLOAD_ENVELOPE_SIZE:
+        raise upload_too_large()
+    
+    part = {"field": b"", "value": b"", "headers": {}, "is_file": False}
+    upload = {"filename": None, "size": 0, "chunks": [], "found": False, "too_large": False}
+    digest = hashlib.sha256()
+    
+    def on_part_begin():
+        part.update(field=b"", value=b"", headers={}, is_file=False)
+    
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+    
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+    
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part.update(field=b"", value=b"")
+    
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if options.get(b"name") == b"file" and not upload["found"]:
+            part["is_file"] = True
+            upload["found"] = True
+            upload["filename"] = options.get(b"filename", b"").decode("utf-8", "replace") or None
+    
+    def on_part_data(data, start, end):
+        if not part["is_file"] or upload["too_large"]:
+            return
+        chunk = data[start:end]
+        upload["size"] += len(chunk)
+        if upload["size"] > MAX_UPLOAD_SIZE:
+            upload["too_large"] = True
+            return
+        digest.update(chunk)
+        upload["chunks"].append(chunk)
+    
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data
+    })
+    
+    temp_path = UPLOAD_DIR / f".{uuid.uuid4()}.part"
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            async for chunk in request.stream():
+                try:
+                    parser.write(chunk)
+                except MultipartParseError:
+                    raise HTTPException(status_code=400, detail="Malformed multipart body")
+                if upload["too_large"]:
+                    raise upload_too_large()
+                if upload["chunks"]:
+                    await f.write(b"".join(upload["chunks"]))
+                    upload["chunks"].clear()
+            parser.finalize()
+        if not upload["found"]:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    
+    return {
+        "path": temp_path,
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "sha256": digest.hexdigest()
+    }
+
+# ==================== ATTACHMENT STORE ====================
+
+# Content-addressed attachment blobs, reference counted in the blobs collection
+class AttachmentStore:
+    url_prefix = "/api/uploads/blobs/"
+
+    def __init__(self, root: Path, gc_interval: float, gc_grace: float):
+        self.root = root
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        self.gc_task: Optional[asyncio.Task] = None
+        self.stored = 0
+        self.deduplicated = 0
+        self.collected = 0
+    
+    def url_for(self, sha256: str, suffix: str) -> str:
+        return f"{self.url_prefix}{sha256[:2]}/{sha256[2:4]}/{sha256}{suffix}"
+    
+    def derivative_url(self, sha256: str, variant: str) -> str:
+        return self.url_for(sha256, f".{variant}.webp")
+    
+    def path_for(self, url: str) -> Path:
+        return self.root / url[len(self.url_prefix):]
+    
+    # Move a finished upload into the store and return its URL
+    async def put(self, temp_path: Path, sha256: str, size: int, ext: str) -> str:
+        if not re.fullmatch(r"\.[A-Za-z0-9]{1,10}", ext):
+            ext = ""
+        url = self.url_for(sha256, ext.lower())
+        now = datetime.now(timezone.utc).isoformat()
+        # Touching last_uploaded_at first keeps the collector off this blob
+        result = await db.blobs.update_one(
+            {"url": url},
+            {
+                "$set": {"last_uploaded_at": now},
+                "$setOnInsert": {"sha256": sha256, "size": size, "refs": 0, "created_at": now}
+            },
+            upsert=True
+        )
+        path = self.path_for(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Replacing an existing blob with identical bytes is harmless; the
+        # collector only ever deletes files it first moved out of the way.
+        os.replace(temp_path, path)
+        if result.upserted_id is None:
+            self.deduplicated += 1
+        else:
+            self.stored += 1
+        return url
+    
+    async def add_references(self, file_urls: List[Optional[str]]):
+        counts = Counter(url for url in file_urls if url and url.startswith(self.url_prefix))
+        if counts:
+            await db.blobs.bulk_write(
+                [UpdateOne({"url": url}, {"$inc": {"refs": n}}) for url, n in counts.items()],
+                ordered=False
+            )
+    
+    async def collect_garbage(self) -> int:
+        cutoff = datetime.fromtimestamp(time.time() - self.gc_grace, timezone.utc).isoformat()
+        removed = 0
+        candidates = db.blobs.find(
+            {"refs": {"$lte": 0}, "last_uploaded_at": {"$lt": cutoff}},
+            {"_id": 0, "url": 1, "sha256": 1}
+        )
+        async for blob in candidates:
+            url = blob["url"]
+            references = await db.messages.count_documents({"file_url": url}, limit=1000)
+            if references:
+                # Counter drifted (e.g. messages written before the store existed)
+                await db.blobs.update_one({"url": url}, {"$set": {"refs": references}})
+                continue
+            # Park the files under private names before dropping the record, so
+            # an upload that lands meanwhile re-creates them and never loses them
+            paths = [self.path_for(url)] + [
+                self.path_for(self.derivative_url(blob["sha256"], variant)) for variant in IMAGE_VARIANTS
+            ]
+            parked = []
+            for path in paths:
+                trash = path.with_name(f".gc-{uuid.uuid4().hex}-{path.name}")
+                try:
+                    os.replace(path, trash)
+                except FileNotFoundError:
+                    continue
+                parked.append((path, trash))
+            result = await db.blobs.delete_one(
+                {"url": url, "refs": {"$lte": 0}, "last_uploaded_at": {"$lt": cutoff}}
+            )
+            for path, trash in parked:
+                if result.deleted_count:
+                    trash.unlink(missing_ok=True)
+                else:
+                    # Uploaded again in between; same bytes, so putting it back is safe
+                    os.replace(trash, path)
+            if result.deleted_count:
+                removed += 1
+        self.collected += removed
+        return removed
     
-    # Generate unique filename
-    ext = Path(file.filename).suffix if file.filename else ""
-    unique_filename = f"{uuid.uuid4()}{ext}"
-    file_path = UPLOAD_DIR / unique_filename
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                removed = await self.collect_garbage()
+                if removed:
+                    logger.info(f"Attachment GC removed {removed} unreferenced blobs")
+            except Exception as e:
+                logger.error(f"Attachment GC failed: {e}")
     
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(content)
+    def start(self):
+        self.gc_task = asyncio.create_task(self._gc_loop())
+    
+    def stop(self):
+        if self.gc_task:
+            self.gc_task.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"stored": self.stored, "deduplicated": self.deduplicated, "collected": self.collected}
+
+attachment_store = AttachmentStore(BLOB_DIR, BLOB_GC_INTERVAL, BLOB_GC_GRACE)
+
+# ==================== IMAGE DERIVATIVES ====================
+
+# Renders thumbnail/preview derivatives of image blobs off the request path
+class ImagePipeline:
+    def __init__(self, workers: int, variants: Dict[str, int], max_pixels: int):
+        self.workers = workers
+        self.variants = variants
+        self.max_pixels = max_pixels
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending: Dict[str, asyncio.Task] = {}
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.render_seconds = 0.0
+    
+    # Schedule rendering for a stored image and return the derivative URLs
+    def submit(self, file_url: str, sha256: str) -> Dict[str, str]:
+        urls = {f"{variant}_url": attachment_store.derivative_url(sha256, variant) for variant in self.variants}
+        targets = [
+            (str(attachment_store.path_for(urls[f"{variant}_url"])), size)
+            for variant, size in self.variants.items()
+        ]
+        # Duplicate uploads reuse the derivatives of the first copy
+        if sha256 in self.pending or all(os.path.exists(path) for path, _ in targets):
+            self.skipped += 1
+        else:
+            source = str(attachment_store.path_for(file_url))
+            self.pending[sha256] = asyncio.create_task(self._render(sha256, source, targets))
+        return urls
+    
+    async def _render(self, sha256: str, source: str, targets: List[tuple]):
+        if self.executor is None:
+            # Forking a threaded event loop process can deadlock the child; start workers
+            # from a clean server that has only the imaging module loaded
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["imaging"])
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        start = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, render_derivatives, source, targets, self.max_pixels
+            )
+            self.rendered += 1
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Could not render derivatives for {sha256}: {e}")
+        finally:
+            self.render_seconds += time.perf_counter() - start
+            self.pending.pop(sha256, None)
+    
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    def stats(self) -> Dict[str, Any]:
+        done = self.rendered + self.failed
+        return {
+            "workers": self.workers,
+            "pending": len(self.pending),
+            "rendered": self.rendered,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "avg_render_ms": round(self.render_seconds / done * 1000, 2) if done else 0.0
+        }
+
+image_pipeline = ImagePipeline(IMAGE_WORKERS, IMAGE_VARIANTS, IMAGE_MAX_PIXELS)
+
+@api_router.post("/upload", openapi_extra={
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"]
+        }}}
+    }
+})
+async def upload_file(request: Request):
+    upload = await receive_upload(request)
+    filename = upload["filename"]
+    
+    # Store by content hash; identical uploads share one blob
+    ext = Path(filename).suffix if filename else ""
+    try:
+        file_url = await attachment_store.put(upload["path"], upload["sha256"], upload["size"], ext)
+    finally:
+        upload["path"].unlink(missing_ok=True)
     
     # Determine file type
     image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
     file_type = "image" if ext.lower() in image_extensions else "file"
     
-    return {
-        "file_url": f"/api/uploads/{unique_filename}",
-        "file_name": file.filename,
-        "file_type": file_type
+    response = {
+        "file_url": file_url,
+        "file_name": filename,
+        "file_type": file_type,
+        "size": upload["size"],
+        "sha256": upload["sha256"],
+        "thumbnail_url": None,
+        "preview_url": None
     }
+    if file_type == "image":
+        response.update(image_pipeline.submit(file_url, upload["sha256"]))
+    return response
+
+# Streams a file, or one byte range of it, using ASGI pathsend when offered
+class AttachmentResponse(Response):
+    chunk_size = 256 * 1024
+    
+    def __init__(self, path: Path, size: int, headers: Dict[str, str], byte_range: Optional[tuple] = None):
+        self.path = path
+        self.start, self.end = byte_range or (0, size - 1)
+        self.partial = byte_range is not None
+        self.background = None
+        self.status_code = 206 if self.partial else 200
+        self.media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        headers = {**headers, "content-length": str(self.end - self.start + 1)}
+        if self.partial:
+            headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+        self.init_headers(headers)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or self.end < self.start:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif not self.partial and "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            async with aiofiles.open(self.path, "rb") as f:
+                await f.seek(self.start)
+                remaining = self.end - self.start + 1
+                while remaining > 0:
+                    chunk = await f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                if remaining > 0:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+# Resolve a single "bytes=" range to inclusive offsets; None serves the whole file
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header, re.IGNORECASE)
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        # Suffix range: the final N bytes; "-0" selects nothing
+        suffix = int(last)
+        start = size - min(suffix, size) if suffix else size
+        end = size - 1
+    if start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+@api_router.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_upload(file_path: str, request: Request):
+    path = (UPLOAD_DIR / file_path).resolve()
+    # Temp files of in-flight uploads start with a dot and are never served
+    if not path.is_relative_to(UPLOAD_DIR.resolve()) or path.name.startswith("."):
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        stat_result = await asyncio.to_thread(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Names are unique per content (hash or uuid), so name and size make a strong validator
+    size = stat_result.st_size
+    etag = '"' + hashlib.sha256(f"{file_path}:{size}".encode()).hexdigest()[:32] + '"'
+    headers = {
+        "etag": etag,
+        "cache-control": ATTACHMENT_CACHE_CONTROL,
+        "accept-ranges": "bytes",
+        "x-content-type-options": "nosniff"
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_byte_range(range_header, size)
+    return AttachmentResponse(path, size, headers, byte_range)
 
 # ==================== WEBSOCKET ENDPOINTS ====================
 
+# The rate-limited kind of an inbound frame; None for control frames
+def frame_kind(data: dict) -> Optional[str]:
+    if data.get("type") == "typing":
+        return "typing"
+    if data.get("type") == "message":
+        return "file" if data.get("file_url") else "message"
+    if data.get("type") in ("resume", "subscribe", "unsubscribe"):
+        return "control"
+    return None
+
+# Apply rate limits and admission control, telling the sender when a frame is dropped
+async def admit_frame(
+    group: str, key: str, websocket: WebSocket, scope: str, kind: str, buckets: Dict[str, TokenBucket]
+) -> bool:
+    retry_after = rate_limiter.check(kind, scope, buckets)
+    if not retry_after:
+        # Control frames are served from memory; a resume that has to read
+        # the database goes through admission itself
+        if kind == "control" or await admission.admit(kind):
+            return True
+        reason, retry_after = "overloaded", 1.0
+    else:
+        reason = "rate_limited"
+    # Dropped typing frames are not worth a reply
+    if kind != "typing":
+        manager.notify(group, key, websocket, {"type": reason, "kind": kind, "retry_after": round(retry_after, 2)})
+    return False
+
 @api_router.websocket("/ws/visitor/{session_id}")
 async def visitor_websocket(websocket: WebSocket, session_id: str):
     await manager.connect_visitor(session_id, websocket)
+    buckets = rate_limiter.connection_buckets()
     try:
         while True:
             data = await websocket.receive_json()
+            manager.touch("visitors", session_id, websocket)
+            kind = frame_kind(data)
+            if kind and not await admit_frame("visitors", session_id, websocket, f"{session_id}/visitor", kind, buckets):
+                continue
             
             if data.get("type") == "message":
+                # Served from memory for every frame after the connect-time load
+                if not await session_cache.get(session_id):
+                    continue
+                
                 # Create message in DB
                 message = Message(
                     session_id=session_id,
@@ -510,65 +2987,65 @@ async def visitor_websocket(websocket: WebSocket, session_id: str):
                     content=data.get("content", ""),
                     message_type=data.get("message_type", "text"),
                     file_url=data.get("file_url"),
-                    file_name=data.get("file_name")
+                    file_name=data.get("file_name"),
+                    thumbnail_url=data.get("thumbnail_url"),
+                    preview_url=data.get("preview_url")
                 )
                 
+                # Store message and session update; fan out once durable
                 doc = message.model_dump()
-                await db.messages.insert_one(doc)
+                try:
+                    session = await message_writer.write(doc)
+                except Exception:
+                    # Already logged by the writer; keep the socket open
+                    manager.notify("visitors", session_id, websocket, {"type": "message_failed", "message_id": doc["id"]})
+                    continue
                 
                 # Remove _id for JSON serialization
                 doc.pop('_id', None)
                 
-                # Update session
-                session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
                 if session:
-                    await db.chat_sessions.update_one(
-                        {"id": session_id},
-                        {"$set": {
-                            "last_message": data.get("content", "")[:100],
-                            "updated_at": datetime.now(timezone.utc).isoformat()
-                        },
-                        "$inc": {"unread_count": 1}}
-                    )
-                    
-                    # Send to assigned agent
-                    if session.get("assigned_agent_id"):
-                        await manager.send_to_agent(session["assigned_agent_id"], {
-                            "type": "new_message",
-                            "message": doc,
-                            "session_id": session_id
-                        })
-                    
-                    # Broadcast to all agents for notification (new message event)
-                    await manager.broadcast_to_agents({
-                        "type": "new_message",
-                        "message": doc,
-                        "session_id": session_id
-                    })
+                    # Full message to agents following the session, summary to the rest
+                    await manager.publish_message(doc)
+                    await manager.publish_summary(session)
+                await typing_indicator.stop(session_id, "visitor")
             
             elif data.get("type") == "typing":
-                session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
-                if session and session.get("assigned_agent_id"):
-                    await manager.send_to_agent(session["assigned_agent_id"], {
-                        "type": "visitor_typing",
-                        "session_id": session_id
-                    })
+                await typing_indicator.touch(session_id, "visitor")
+            
+            elif data.get("type") == "resume":
+                last_seq = data.get("last_seq")
+                if isinstance(last_seq, int) and last_seq >= 0:
+                    await manager.resume("visitors", session_id, websocket, session_id, last_seq)
     
     except WebSocketDisconnect:
-        manager.disconnect_visitor(session_id)
+        pass
+    finally:
+        if manager.disconnect_visitor(session_id, websocket):
+            await typing_indicator.stop(session_id, "visitor")
 
 @api_router.websocket("/ws/agent/{agent_id}")
 async def agent_websocket(websocket: WebSocket, agent_id: str):
     await manager.connect_agent(agent_id, websocket)
+    buckets = rate_limiter.connection_buckets()
     try:
         while True:
             data = await websocket.receive_json()
+            manager.touch("agents", agent_id, websocket)
+            kind = frame_kind(data)
+            # Frames without a session (subscribe) are limited per agent instead
+            session_id = data.get("session_id")
+            scope = f"{session_id}/agent" if isinstance(session_id, str) else f"agent {agent_id}"
+            if kind and not await admit_frame("agents", agent_id, websocket, scope, kind, buckets):
+                continue
             
             if data.get("type") == "message":
                 session_id = data.get("session_id")
+                if not session_id or not await session_cache.get(session_id):
+                    continue
                 
                 # Get agent info
-                agent = await db.agents.find_one({"id": agent_id}, {"_id": 0, "password_hash": 0})
+                agent = await agent_cache.get(agent_id)
                 
                 # Create message in DB
                 message = Message(
@@ -579,46 +3056,52 @@ async def agent_websocket(websocket: WebSocket, agent_id: str):
                     content=data.get("content", ""),
                     message_type=data.get("message_type", "text"),
                     file_url=data.get("file_url"),
-                    file_name=data.get("file_name")
+                    file_name=data.get("file_name"),
+                    thumbnail_url=data.get("thumbnail_url"),
+                    preview_url=data.get("preview_url")
                 )
                 
+                # Store message and session update; fan out once durable
                 doc = message.model_dump()
-                await db.messages.insert_one(doc)
+                try:
+                    session = await message_writer.write(doc)
+                except Exception:
+                    # Already logged by the writer; keep the socket open
+                    manager.notify("agents", agent_id, websocket, {"type": "message_failed", "message_id": doc["id"]})
+                    continue
                 
                 # Remove _id for JSON serialization
                 doc.pop('_id', None)
                 
-                # Update session
-                await db.chat_sessions.update_one(
-                    {"id": session_id},
-                    {"$set": {
-                        "last_message": data.get("content", "")[:100],
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                # Send to visitor
-                await manager.send_to_visitor(session_id, {
-                    "type": "new_message",
-                    "message": doc
-                })
-                
-                # Broadcast to other agents
-                await manager.broadcast_to_agents({
-                    "type": "new_message",
-                    "message": doc,
-                    "session_id": session_id
-                })
+                # Send to the visitor and other agents following the session
+                if session:
+                    await manager.publish_message(doc)
+                    await manager.publish_summary(session)
+                await typing_indicator.stop(session_id, agent_id)
             
             elif data.get("type") == "typing":
                 session_id = data.get("session_id")
-                await manager.send_to_visitor(session_id, {
-                    "type": "agent_typing",
-                    "session_id": session_id
-                })
+                if isinstance(session_id, str):
+                    await typing_indicator.touch(session_id, agent_id)
+            
+            elif data.get("type") == "resume":
+                session_id = data.get("session_id")
+                last_seq = data.get("last_seq")
+                if isinstance(session_id, str) and isinstance(last_seq, int) and last_seq >= 0:
+                    await manager.resume("agents", agent_id, websocket, session_id, last_seq)
+            
+            elif data.get("type") in ("subscribe", "unsubscribe"):
+                topics = [t for t in data.get("topics", []) if isinstance(t, str) and "," not in t]
+                if data["type"] == "subscribe":
+                    manager.subscribe(agent_id, topics)
+                else:
+                    manager.unsubscribe(agent_id, topics)
     
     except WebSocketDisconnect:
-        await manager.disconnect_agent(agent_id)
+        pass
+    finally:
+        if manager.disconnect_agent(agent_id, websocket):
+            await typing_indicator.stop_participant(agent_id)
 
 # ==================== ROOT ENDPOINT ====================
 
@@ -626,14 +3109,43 @@ async def agent_websocket(websocket: WebSocket, agent_id: str):
 async def root():
     return {"message": "24gameapi Chat API"}
 
+@api_router.get("/admin/metrics")
+async def get_metrics():
+    return {
+        "message_writer": message_writer.stats(),
+        "change_log": change_log.stats(),
+        "password_hasher": password_hasher.stats(),
+        "attachments": attachment_store.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "typing": typing_indicator.stats(),
+        "replay": {"sessions": len(manager.replay), "resumes": manager.resumes},
+        "connections": manager.connection_stats(),
+        "rate_limits": rate_limiter.stats(),
+        "admission": admission.stats(),
+        "routing": router.stats(),
+        "caches": {
+            "sessions": session_cache.stats(),
+            "agents": agent_cache.stats(),
+            "tokens": token_cache.stats()
+        }
+    }
+
+@api_router.get("/admin/indexes")
+async def check_indexes():
+    report = await verify_query_plans()
+    failing = [r["name"] for r in report if r["collscan"]]
+    if failing:
+        raise HTTPException(
+            status_code=503,
+            detail={"message": "Query shapes fall back to COLLSCAN", "failing": failing, "plans": report}
+        )
+    return {"status": "ok", "plans": report}
+
 # ==================== STATIC FILES & CONFIG ====================
 
 # Include the router in the main app FIRST
 app.include_router(api_router)
 
-# Mount uploads directory AFTER router (so it doesn't catch all /api routes)
-app.mount("/api/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
-
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -642,6 +3154,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def run_migrations():
+    await migrate_read_watermarks()
+    await migrate_change_versions()
+
+@app.on_event("startup")
+async def start_broker():
+    await manager.broker.start()
+
+@app.on_event("startup")
+async def take_worker_lease():
+    await manager.renew_lease()
+
+@app.on_event("startup")
+async def start_connection_reaper():
+    manager.start_reaper()
+
+@app.on_event("startup")
+async def start_admission_monitor():
+    admission.start()
+
+@app.on_event("startup")
+async def start_attachment_gc():
+    attachment_store.start()
+
+@app.on_event("startup")
+async def restore_routing_queue():
+    await router.restore()
+
+@app.on_event("shutdown")
+async def flush_presence():
+    await manager.flush_presence()
+
+@app.on_event("shutdown")
+async def release_worker_lease():
+    await manager.release_lease()
+
+@app.on_event("shutdown")
+async def stop_broker():
+    await manager.broker.stop()
+
+@app.on_event("shutdown")
+async def stop_connection_reaper():
+    manager.stop_reaper()
+
+@app.on_event("shutdown")
+async def stop_admission_monitor():
+    admission.stop()
+
+@app.on_event("shutdown")
+async def stop_attachment_gc():
+    attachment_store.stop()
+
+@app.on_event("shutdown")
+async def stop_router():
+    router.stop()
+
+@app.on_event("shutdown")
+async def stop_image_pipeline():
+    image_pipeline.shutdown()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import httpx
+from starlette.staticfiles import StaticFiles
+
+# server.py reads these at import time. Only the upload benchmarks touch
+# MongoDB, to register the stored blob.
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server  # noqa: E402
+
+SAMPLE_EVENT = {
+    "type": "new_message",
+    "session_id": "5f0c6a52-8a3e-4c55-a8d3-0b8f5d2a9c11",
+    "message": {
+        "id": "0b6f1f0e-9c0f-4a3e-9f55-5d1c1f7f7b2a",
+        "session_id": "5f0c6a52-8a3e-4c55-a8d3-0b8f5d2a9c11",
+        "sender_type": "visitor",
+        "sender_id": "7a1d2c3b-4e5f-6a7b-8c9d-0e1f2a3b4c5d",
+        "sender_name": "Visitor",
+        "content": "Hi, I would like to know more about the pricing of the premium plan " * 3,
+        "message_type": "text",
+        "file_url": None,
+        "file_name": None,
+        "created_at": "2026-02-01T10:00:00.000000+00:00",
+        "is_read": False
+    }
+}
+
+class FakeWebSocket:
+    """Accepts frames instantly so only server-side CPU is measured."""
+
+    def __init__(self):
+        self.frames = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data):
+        self.frames += 1
+
+    async def send_json(self, data):
+        # Mirrors starlette's WebSocket.send_json
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def close(self, code=1000):
+        pass
+
+class ChatBenchmark:
+    def __init__(self, rounds=200):
+        self.rounds = rounds
+        self.results = []
+
+    def log_result(self, name, **fields):
+        print(f"⏱  {name}: " + ", ".join(f"{k}={v}" for k, v in fields.items()))
+        self.results.append({"benchmark": name, **fields})
+
+    async def _legacy_broadcast(self, sockets, message):
+        # The pre-queue implementation: one send_json (and one encode) per agent
+        for websocket in sockets:
+            await websocket.send_json(message)
+
+    async def _manager_broadcast(self, agents):
+        manager = server.ConnectionManager()
+        sockets = []
+        for i in range(agents):
+            websocket = FakeWebSocket()
+            sockets.append(websocket)
+            manager._register("agents", f"agent-{i}", websocket)
+
+        start = time.process_time()
+        for _ in range(self.rounds):
+            await manager.broadcast_to_agents(SAMPLE_EVENT)
+            # Let every writer task drain its queue
+            await asyncio.sleep(0)
+        elapsed = time.process_time() - start
+
+        for connections in manager.active_connections["agents"].values():
+            for connection in connections.values():
+                connection.writer.cancel()
+        return elapsed, sum(ws.frames for ws in sockets)
+
+    async def bench_broadcast_encoding(self, agents):
+        """Compare per-recipient json encoding with encode-once fan-out"""
+        sockets = [FakeWebSocket() for _ in range(agents)]
+        start = time.process_time()
+        for _ in range(self.rounds):
+            await self._legacy_broadcast(sockets, SAMPLE_EVENT)
+        legacy = time.process_time() - start
+
+        encoded, frames = await self._manager_broadcast(agents)
+        sends = self.rounds * agents
+        self.log_result(
+            f"Broadcast to {agents} agents",
+            frames=frames,
+            legacy_us_per_recipient=round(legacy / sends * 1e6, 2),
+            encode_once_us_per_recipient=round(encoded / sends * 1e6, 2),
+            saved_us_per_recipient=round((legacy - encoded) / sends * 1e6, 2)
+        )
+
+    async def _stream_upload(self, size, chunk_size=64 * 1024):
+        """POST a multipart upload of `size` bytes without ever holding it in memory"""
+        boundary = "benchmarkboundary"
+        chunk = b"x" * chunk_size
+
+        async def body():
+            yield (
+                f"--{boundary}\r\n"
+                'Content-Disposition: form-data; name="file"; filename="blob.bin"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            remaining = size
+            while remaining > 0:
+                yield chunk[:min(chunk_size, remaining)]
+                remaining -= chunk_size
+            yield f"\r\n--{boundary}--\r\n".encode()
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            return await client.post(
+                "/api/upload",
+                content=body(),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+            )
+
+    async def _discard_blob(self, file_url):
+        store = server.attachment_store
+        await server.db.blobs.delete_one({"url": file_url})
+        (store.root / file_url[len(store.url_prefix):]).unlink(missing_ok=True)
+
+    async def bench_upload_memory(self, size_mb, limit_mb=4):
+        """Peak server-side allocation while streaming an upload of size_mb"""
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = await self._stream_upload(size_mb * 1024 * 1024)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if response.status_code == 200:
+            await self._discard_blob(response.json()["file_url"])
+
+        peak_mb = peak / (1024 * 1024)
+        self.log_result(
+            f"Upload {size_mb} MB",
+            status=response.status_code,
+            seconds=round(elapsed, 3),
+            peak_mb=round(peak_mb, 2)
+        )
+        assert peak_mb < limit_mb, f"Upload of {size_mb} MB peaked at {peak_mb:.1f} MB"
+
+    async def _read_throughput(self, app, url, requests, headers=None):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            received = 0
+            start = time.perf_counter()
+            for i in range(requests):
+                response = await client.get(url, headers=headers(i) if headers else None)
+                received += len(response.content)
+            elapsed = time.perf_counter() - start
+        return requests / elapsed, received / elapsed / (1024 * 1024), response.status_code
+
+    async def bench_attachment_reads(self, size_mb=8, requests=50):
+        """Repeated, revalidated and ranged reads: serve_upload vs a plain StaticFiles mount"""
+        path = server.UPLOAD_DIR / "benchmark-attachment.bin"
+        size = size_mb * 1024 * 1024
+        path.write_bytes(os.urandom(size))
+        url = f"/api/uploads/{path.name}"
+        static = StaticFiles(directory=str(server.UPLOAD_DIR))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://benchmark") as client:
+                etag = (await client.head(url)).headers["etag"]
+
+            def ranged(i):
+                offset = (i * 7919 * 64 * 1024) % (size - 64 * 1024)
+                return {"Range": f"bytes={offset}-{offset + 64 * 1024 - 1}"}
+
+            cases = [
+                ("full", None),
+                ("revalidate", lambda i: {"If-None-Match": etag}),
+                ("range 64KB", ranged),
+            ]
+            for name, headers in cases:
+                rps, mbps, code = await self._read_throughput(server.app, url, requests, headers)
+                legacy_rps, legacy_mbps, legacy_code = await self._read_throughput(
+                    static, f"/{path.name}", requests, headers
+                )
+                self.log_result(
+                    f"Attachment {name} reads ({size_mb} MB file)",
+                    status=code,
+                    req_per_s=round(rps, 1),
+                    mb_per_s=round(mbps, 1),
+                    static_status=legacy_code,
+                    static_req_per_s=round(legacy_rps, 1),
+                    static_mb_per_s=round(legacy_mbps, 1)
+                )
+        finally:
+            path.unlink(missing_ok=True)
+
+    async def bench_routing(self, agents, operations=20000):
+        """Per-pick cost of the routing heap: pick the least loaded agent, then re-key it"""
+        router = server.SessionRouter(capacity=operations, enabled=False)
+        for i in range(agents):
+            router.add_agent(f"agent-{i}", i % 5)
+
+        start = time.process_time()
+        for i in range(operations):
+            agent_id = router._least_loaded()
+            router.adjust(agent_id, 1 if i % 3 else -1)
+        elapsed = time.process_time() - start
+        self.log_result(
+            f"Route among {agents} agents",
+            us_per_assignment=round(elapsed / operations * 1e6, 2),
+            heap_entries=len(router.heap)
+        )
+
+    async def run_all(self):
+        print("=" * 60)
+        print("🚀 Starting Chat Backend Benchmarks")
+        print("=" * 60)
+
+        for agents in (100, 250, 500):
+            await self.bench_broadcast_encoding(agents)
+
+        # Peak memory must not grow with file size, including oversized uploads
+        for size_mb in (1, 8, 50):
+            await self.bench_upload_memory(size_mb)
+
+        await self.bench_attachment_reads()
+
+        # Assignment cost should grow with log(agents), not agents
+        for agents in (100, 10000, 100000):
+            await self.bench_routing(agents)
+
+        return self.results
+
+def main():
+    """Main benchmark runner"""
+    benchmark = ChatBenchmark()
+    asyncio.run(benchmark.run_all())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
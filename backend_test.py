@@ -3,8 +3,12 @@
 import requests
 import sys
 import json
+import asyncio
+import os
 from datetime import datetime
+from pathlib import Path
 import time
+from websockets.sync.client import connect as ws_connect
 
 class ChatAPITester:
     def __init__(self, base_url="https://live-messenger-11.preview.emergentagent.com"):
@@ -338,6 +342,218 @@ class ChatAPITester:
         )
         return success
 
+    def test_file_upload(self):
+        """Test streamed upload and the early size limit"""
+        try:
+            response = requests.post(
+                f"{self.api_url}/upload",
+                files={"file": ("note.txt", b"hello", "text/plain")},
+                timeout=10
+            )
+            data = response.json()
+            success = response.status_code == 200 and data.get("size") == 5 and data.get("file_type") == "file"
+            self.log_test("File Upload", success, f"Got {response.status_code}: {response.text[:200]}", data)
+
+            response = requests.post(
+                f"{self.api_url}/upload",
+                files={"file": ("big.bin", b"0" * (10 * 1024 * 1024 + 1), "application/octet-stream")},
+                timeout=30
+            )
+            too_large = response.status_code == 400
+            self.log_test("File Upload Size Limit", too_large, f"Expected 400, got {response.status_code}")
+            return success and too_large
+        except Exception as e:
+            self.log_test("File Upload", False, f"Error: {str(e)}")
+            return False
+
+    def test_attachment_caching(self):
+        """Test validators, immutable caching and ranged reads on uploads"""
+        try:
+            upload = requests.post(
+                f"{self.api_url}/upload",
+                files={"file": ("range.txt", b"0123456789", "text/plain")},
+                timeout=10
+            ).json()
+            url = f"{self.base_url}{upload['file_url']}"
+
+            response = requests.get(url, timeout=10)
+            etag = response.headers.get("ETag", "")
+            cached = response.status_code == 200 and etag.startswith('"') and "immutable" in response.headers.get("Cache-Control", "")
+            self.log_test("Attachment Cache Headers", cached, f"Got {response.status_code}: {dict(response.headers)}")
+
+            response = requests.get(url, headers={"If-None-Match": etag}, timeout=10)
+            revalidated = response.status_code == 304
+            self.log_test("Attachment Revalidation", revalidated, f"Expected 304, got {response.status_code}")
+
+            response = requests.get(url, headers={"Range": "bytes=2-4"}, timeout=10)
+            ranged = response.status_code == 206 and response.content == b"234"
+            self.log_test("Attachment Range", ranged, f"Got {response.status_code}: {response.content[:20]}")
+            return cached and revalidated and ranged
+        except Exception as e:
+            self.log_test("Attachment Caching", False, f"Error: {str(e)}")
+            return False
+
+    def test_sync(self):
+        """Test snapshot, delta and 304 responses from the change feed"""
+        try:
+            response = requests.get(f"{self.api_url}/sync", timeout=10)
+            snapshot = response.json()
+            success = response.status_code == 200 and snapshot.get("full") is True
+            self.log_test("Sync Snapshot", success, f"Got {response.status_code}: {response.text[:200]}")
+
+            version = snapshot.get("version", 0)
+            response = requests.get(
+                f"{self.api_url}/sync",
+                params={"since": version},
+                headers={"If-None-Match": response.headers.get("ETag", "")},
+                timeout=10
+            )
+            unchanged = response.status_code == 304
+            self.log_test("Sync Not Modified", unchanged, f"Expected 304, got {response.status_code}")
+
+            requests.put(f"{self.api_url}/sessions/{self.session_id}/read", timeout=10)
+            response = requests.get(f"{self.api_url}/sync", params={"since": version}, timeout=10)
+            delta = response.json()
+            changed = response.status_code == 200 and any(s["id"] == self.session_id for s in delta.get("sessions", []))
+            self.log_test("Sync Delta", changed, f"Got {response.status_code}: {response.text[:200]}")
+            return success and unchanged and changed
+        except Exception as e:
+            self.log_test("Sync", False, f"Error: {str(e)}")
+            return False
+
+    def test_dashboard_snapshot(self):
+        """Test the one-call dashboard bootstrap with a selected session"""
+        if not self.session_id:
+            self.log_test("Dashboard Snapshot", False, "No session ID available")
+            return False
+
+        success, response = self.run_test(
+            "Dashboard Snapshot",
+            "GET",
+            f"dashboard/snapshot?session_id={self.session_id}&tail=10",
+            200
+        )
+        if success and response.get("session", {}).get("id") != self.session_id:
+            self.log_test("Dashboard Snapshot Session", False, "Selected session missing from snapshot")
+            return False
+        return success
+
+    def _new_session(self, name):
+        """Create a fresh visitor and session, independent of the main flow"""
+        visitor = requests.post(f"{self.api_url}/visitors", json={"name": name, "source": "web"}, timeout=10).json()
+        return requests.post(
+            f"{self.api_url}/sessions",
+            params={"visitor_id": visitor["id"], "visitor_name": name},
+            timeout=10
+        ).json()
+
+    def test_message_seq_ordering(self):
+        """Test that a burst of messages gets contiguous seqs matching last_seq"""
+        try:
+            session = self._new_session("Seq Visitor")
+            url = f"{self.api_url}/sessions/{session['id']}/messages"
+            params = {"sender_type": "visitor", "sender_id": session["visitor_id"]}
+            for i in range(5):
+                requests.post(url, params=params, json={"content": f"seq {i}"}, timeout=10)
+
+            page = requests.get(url, timeout=10).json()
+            seqs = [m["seq"] for m in page["messages"]]
+            last_seq = requests.get(f"{self.api_url}/sessions/{session['id']}", timeout=10).json()["last_seq"]
+            success = seqs == [5, 4, 3, 2, 1] and last_seq == 5
+            self.log_test("Message Seq Ordering", success, f"seqs={seqs}, last_seq={last_seq}")
+            return success
+        except Exception as e:
+            self.log_test("Message Seq Ordering", False, f"Error: {str(e)}")
+            return False
+
+    def test_queue_position(self):
+        """Test the waiting queue position of a new session"""
+        try:
+            session = self._new_session("Queue Visitor")
+            response = requests.get(f"{self.api_url}/sessions/{session['id']}/queue", timeout=10)
+            if response.status_code == 404:
+                # An online agent with free capacity took it straight away
+                status = requests.get(f"{self.api_url}/sessions/{session['id']}", timeout=10).json()["status"]
+                success = status == "active"
+                details = f"Not queued, but session status is {status}"
+            else:
+                data = response.json()
+                success = response.status_code == 200 and 1 <= data.get("position", 0) <= data.get("waiting", 0)
+                details = f"Got {response.status_code}: {response.text[:200]}"
+            self.log_test("Queue Position", success, details)
+            requests.put(f"{self.api_url}/sessions/{session['id']}/close", timeout=10)
+            return success
+        except Exception as e:
+            self.log_test("Queue Position", False, f"Error: {str(e)}")
+            return False
+
+    def test_resume(self):
+        """Test that a reconnecting visitor is replayed the messages after its last seq"""
+        if not self.session_id:
+            self.log_test("WebSocket Resume", False, "No session ID available")
+            return False
+        try:
+            ws_url = self.base_url.replace("http", "ws", 1)
+            with ws_connect(f"{ws_url}/api/ws/visitor/{self.session_id}", open_timeout=10) as websocket:
+                websocket.send(json.dumps({"type": "resume", "last_seq": 0}))
+                replayed = []
+                while True:
+                    frame = json.loads(websocket.recv(timeout=10))
+                    if frame["type"] == "new_message":
+                        replayed.append(frame["seq"])
+                    elif frame["type"] == "resumed":
+                        break
+            success = bool(replayed) and replayed == list(range(1, len(replayed) + 1)) and frame["seq"] == replayed[-1]
+            self.log_test("WebSocket Resume", success, f"replayed={replayed}, resumed={frame}")
+            return success
+        except Exception as e:
+            self.log_test("WebSocket Resume", False, f"Error: {str(e)}")
+            return False
+
+    def test_redis_broker(self):
+        """Test a RedisBroker round trip between two workers on a local fakeredis"""
+        try:
+            import fakeredis
+            os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+            os.environ.setdefault("DB_NAME", "broker_test")
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            import server
+
+            async def round_trip():
+                redis_server = fakeredis.FakeServer()
+                received = {"a": [], "b": []}
+                brokers = {}
+                for name in received:
+                    broker = server.RedisBroker(client=fakeredis.aioredis.FakeRedis(server=redis_server))
+                    broker.attach(lambda target, key, payload, name=name: received[name].append((target, key, payload)))
+                    await broker.start()
+                    brokers[name] = broker
+                await asyncio.sleep(0.1)
+                await brokers["a"].publish("visitor", "session-1", '{"type":"ping"}\nwith newline')
+                await asyncio.sleep(0.1)
+                for broker in brokers.values():
+                    await broker.stop()
+                return received
+
+            received = asyncio.run(round_trip())
+            expected = [("visitor", "session-1", '{"type":"ping"}\nwith newline')]
+            success = received["a"] == expected and received["b"] == expected
+            self.log_test("Redis Broker Round Trip", success, f"Got {received}")
+            return success
+        except Exception as e:
+            self.log_test("Redis Broker Round Trip", False, f"Error: {str(e)}")
+            return False
+
+    def test_index_plans(self):
+        """Test that no hot query shape falls back to a collection scan"""
+        success, response = self.run_test(
+            "Index Query Plans",
+            "GET",
+            "admin/indexes",
+            200
+        )
+        return success
+
     def run_all_tests(self):
         """Run all API tests in sequence"""
         print("=" * 60)
@@ -348,6 +564,7 @@ class ChatAPITester:
         # Test sequence
         tests = [
             self.test_root_endpoint,
+            self.test_index_plans,
             self.test_visitor_creation,
             self.test_get_visitor,
             self.test_session_creation,
@@ -359,8 +576,16 @@ class ChatAPITester:
             self.test_assign_session,
             self.test_create_message,
             self.test_get_messages,
+            self.test_message_seq_ordering,
+            self.test_resume,
+            self.test_queue_position,
             self.test_mark_messages_read,
-            self.test_close_session
+            self.test_sync,
+            self.test_dashboard_snapshot,
+            self.test_file_upload,
+            self.test_attachment_caching,
+            self.test_close_session,
+            self.test_redis_broker
         ]
 
         for test in tests:
@@ -55,14 +55,16 @@ export default function ChatPanel({
         const res = await axios.post(`${API}/upload`, formData, {
           headers: { 'Content-Type': 'multipart/form-data' }
         });
-        const { file_url, file_name, file_type } = res.data;
+        const { file_url, file_name, file_type, thumbnail_url, preview_url } = res.data;
         const content = newMessage.trim() || (file_type === 'image' ? 'Shared an image' : `Shared file: ${file_name}`);
         
         onSendMessage({
           content,
           message_type: file_type,
           file_url,
-          file_name
+          file_name,
+          thumbnail_url,
+          preview_url
         });
         
         clearPendingFile();
@@ -200,11 +202,23 @@ export default function ChatPanel({
                   : `${cardBg} ${textColor} rounded-bl-sm`
               }`}>
                 {msg.message_type === 'image' && msg.file_url && (
-                  <img
-                    src={`${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`}
-                    alt="Shared"
-                    className="rounded-lg max-w-[200px] mb-2"
-                  />
+                  <a
+                    href={`${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`}
+                    target="_blank"
+                    rel="noopener noreferrer"
+                  >
+                    <img
+                      src={`${process.env.REACT_APP_BACKEND_URL}${msg.thumbnail_url || msg.file_url}`}
+                      onError={(e) => {
+                        // The thumbnail may still be rendering; show the original meanwhile
+                        const original = `${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`;
+                        if (e.currentTarget.src !== original) e.currentTarget.src = original;
+                      }}
+                      loading="lazy"
+                      alt="Shared"
+                      className="rounded-lg max-w-[200px] mb-2"
+                    />
+                  </a>
                 )}
                 
                 {msg.message_type === 'file' && msg.file_url && (
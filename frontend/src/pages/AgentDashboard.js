@@ -41,12 +41,21 @@ export default function AgentDashboard() {
 
   const wsRef = useRef(null);
   const selectedSessionRef = useRef(null);
+  const sessionsRef = useRef([]);
+  const typingTimeoutRef = useRef(null);
+  // Highest seq seen for the open conversation, used to resume after a reconnect
+  const lastSeqRef = useRef(0);
+  const [reconnectKey, setReconnectKey] = useState(0);
 
-  // Keep ref in sync
+  // Keep refs in sync
   useEffect(() => {
     selectedSessionRef.current = selectedSession;
   }, [selectedSession]);
 
+  useEffect(() => {
+    sessionsRef.current = sessions;
+  }, [sessions]);
+
   // Auth check
   useEffect(() => {
     const token = localStorage.getItem('agent_token');
@@ -72,22 +81,55 @@ export default function AgentDashboard() {
     }
   }, []);
 
-  // Fetch data
+  // Fetch data: one bootstrap snapshot, then only what changed since its version
   useEffect(() => {
     if (!agent) return;
+    let version = 0;
+    const merge = (prev, changed, removed) => {
+      const updates = Object.fromEntries(changed.map(r => [r.id, r]));
+      const merged = prev
+        .filter(r => !removed.includes(r.id))
+        .map(r => updates[r.id] ? { ...r, ...updates[r.id] } : r);
+      const known = new Set(prev.map(r => r.id));
+      return [...changed.filter(r => !known.has(r.id)).reverse(), ...merged];
+    };
+    const fetchSnapshot = async () => {
+      try {
+        const res = await axios.get(`${API}/dashboard/snapshot`, {
+          params: { closed: 50 }
+        });
+        const closed = res.data.closed?.sessions || [];
+        setSessions([...res.data.sessions, ...closed].sort((a, b) => b.updated_at.localeCompare(a.updated_at)));
+        setAgents(res.data.agents);
+        version = res.data.version;
+      } catch (error) {
+        console.error('Error fetching dashboard:', error);
+      }
+    };
     const fetchData = async () => {
       try {
-        const [sessionsRes, agentsRes] = await Promise.all([
-          axios.get(`${API}/sessions`),
-          axios.get(`${API}/agents`)
-        ]);
-        setSessions(sessionsRes.data);
-        setAgents(agentsRes.data);
+        const res = await axios.get(`${API}/sync`, {
+          params: { since: version, limit: 100 },
+          headers: version ? { 'If-None-Match': `"sync-${version}"` } : {},
+          validateStatus: status => status === 200 || status === 304
+        });
+        if (res.status === 304) return;
+        const data = res.data;
+        if (data.full) {
+          // Snapshot pages come oldest change first
+          setSessions([...data.sessions].reverse());
+          setAgents(data.agents);
+        } else {
+          setSessions(prev => merge(prev, data.sessions, data.removed.sessions));
+          setAgents(prev => merge(prev, data.agents, data.removed.agents));
+        }
+        version = data.version;
+        if (data.has_more) fetchData();
       } catch (error) {
         console.error('Error fetching data:', error);
       }
     };
-    fetchData();
+    fetchSnapshot();
     const interval = setInterval(fetchData, 15000);
     return () => clearInterval(interval);
   }, [agent]);
@@ -97,14 +139,52 @@ export default function AgentDashboard() {
     if (!agent) return;
     const wsUrl = `${process.env.REACT_APP_BACKEND_URL.replace('http', 'ws')}/api/ws/agent/${agent.id}`;
     const ws = new WebSocket(wsUrl);
+    let disposed = false;
 
-    ws.onopen = () => setIsConnected(true);
+    ws.onopen = () => {
+      setIsConnected(true);
+      const currentSession = selectedSessionRef.current;
+      if (currentSession) {
+        ws.send(JSON.stringify({ type: 'resume', session_id: currentSession.id, last_seq: lastSeqRef.current }));
+      }
+    };
     
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      if (data.type === 'ping') {
+        ws.send(JSON.stringify({ type: 'pong' }));
+        return;
+      }
       const currentSession = selectedSessionRef.current;
+      if (data.session_id === currentSession?.id && data.seq > lastSeqRef.current) {
+        lastSeqRef.current = data.seq;
+      }
       
-      if (data.type === 'new_message') {
+      if (data.type === 'resumed') {
+        // Assignment and closing are not replayed; the session state they left is applied here
+        setSessions(prev => prev.map(s => s.id === data.session.id ? { ...s, ...data.session } : s));
+        if (data.session_id === currentSession?.id) {
+          setSelectedSession(prev => (prev?.id === data.session.id ? { ...prev, ...data.session } : prev));
+        }
+        if (data.has_more && data.session_id === currentSession?.id) {
+          ws.send(JSON.stringify({ type: 'resume', session_id: data.session_id, last_seq: lastSeqRef.current }));
+        }
+      } else if ((data.type === 'rate_limited' || data.type === 'overloaded') && data.kind === 'control') {
+        // Throttled subscribe/resume frames are retried for the open conversation
+        setTimeout(() => {
+          const session = selectedSessionRef.current;
+          if (session && ws.readyState === WebSocket.OPEN) {
+            ws.send(JSON.stringify({ type: 'subscribe', topics: [`session:${session.id}`] }));
+            ws.send(JSON.stringify({ type: 'resume', session_id: session.id, last_seq: lastSeqRef.current }));
+          }
+        }, data.retry_after * 1000);
+      } else if (data.type === 'rate_limited' || data.type === 'overloaded') {
+        toast.error(data.type === 'rate_limited'
+          ? 'You are sending messages too quickly. Please wait a moment.'
+          : 'The chat is busy right now. Please try again shortly.');
+      } else if (data.type === 'message_failed') {
+        toast.error('Your message could not be sent. Please try again.');
+      } else if (data.type === 'new_message') {
         if (data.session_id === currentSession?.id && data.message.sender_type === 'visitor') {
           setMessages(prev => {
             if (prev.some(m => m.id === data.message.id)) return prev;
@@ -112,19 +192,26 @@ export default function AgentDashboard() {
           });
           setVisitorTyping(false);
         }
-        
-        setSessions(prev => prev.map(s => 
-          s.id === data.session_id 
-            ? { ...s, last_message: data.message.content?.substring(0, 100), updated_at: new Date().toISOString(), unread_count: (s.unread_count || 0) + (data.message.sender_type === 'visitor' ? 1 : 0) }
-            : s
-        ));
 
+        // Full messages only arrive for sessions we follow; the list itself
+        // is kept up to date by session_summary events.
         if (data.message.sender_type === 'visitor') {
           playNotification('visitor');
           if ('Notification' in window && Notification.permission === 'granted') {
             new Notification('New Message', { body: data.message.content });
           }
         }
+      } else if (data.type === 'session_summary') {
+        const updates = Object.fromEntries(data.sessions.map(s => [s.id, s]));
+        const hasNewVisitorMessage = sessionsRef.current.some(s => {
+          const update = updates[s.id];
+          return update
+            && update.unread_count > (s.unread_count || 0)
+            && s.id !== currentSession?.id
+            && update.assigned_agent_id !== agent.id;
+        });
+        setSessions(prev => prev.map(s => updates[s.id] ? { ...s, ...updates[s.id] } : s));
+        if (hasNewVisitorMessage) playNotification('visitor');
       } else if (data.type === 'new_session') {
         setSessions(prev => [data.session, ...prev]);
         toast.info(`New chat from ${data.session.visitor_name || 'Visitor'}`);
@@ -132,23 +219,50 @@ export default function AgentDashboard() {
       } else if (data.type === 'session_updated' || data.type === 'session_closed') {
         setSessions(prev => prev.map(s => s.id === data.session.id ? data.session : s));
       } else if (data.type === 'visitor_typing' && data.session_id === currentSession?.id) {
-        setVisitorTyping(true);
-        setTimeout(() => setVisitorTyping(false), 3000);
+        // The server coalesces keystrokes into start/stop transitions
+        clearTimeout(typingTimeoutRef.current);
+        setVisitorTyping(data.state !== 'stop');
+        if (data.state !== 'stop') {
+          // Safety net in case the stop event is lost with the connection
+          typingTimeoutRef.current = setTimeout(() => setVisitorTyping(false), 30000);
+        }
       }
     };
 
-    ws.onclose = () => setIsConnected(false);
+    ws.onclose = () => {
+      setIsConnected(false);
+      // Reconnect; the open conversation then resumes from lastSeqRef
+      if (!disposed) setTimeout(() => setReconnectKey(k => k + 1), 2000);
+    };
     wsRef.current = ws;
-    return () => ws.close();
-  }, [agent]);
+    return () => {
+      disposed = true;
+      ws.close();
+    };
+  }, [agent, reconnectKey]);
+
+  // Follow the open conversation so its messages and typing events arrive in full
+  useEffect(() => {
+    const ws = wsRef.current;
+    if (!isConnected || !selectedSession || ws?.readyState !== WebSocket.OPEN) return;
+    const topics = [`session:${selectedSession.id}`];
+    ws.send(JSON.stringify({ type: 'subscribe', topics }));
+    return () => {
+      if (ws.readyState === WebSocket.OPEN && selectedSession.assigned_agent_id !== agent?.id) {
+        ws.send(JSON.stringify({ type: 'unsubscribe', topics }));
+      }
+    };
+  }, [isConnected, selectedSession?.id]);
 
   // Load messages
   useEffect(() => {
     if (!selectedSession) return;
     const fetchMessages = async () => {
       try {
+        lastSeqRef.current = 0;
         const res = await axios.get(`${API}/sessions/${selectedSession.id}/messages`);
-        setMessages(res.data);
+        setMessages([...res.data.messages].reverse());
+        lastSeqRef.current = Math.max(lastSeqRef.current, res.data.messages[0]?.seq || 0);
         await axios.put(`${API}/sessions/${selectedSession.id}/read`);
         setSessions(prev => prev.map(s => s.id === selectedSession.id ? { ...s, unread_count: 0 } : s));
       } catch (error) {
@@ -160,6 +274,10 @@ export default function AgentDashboard() {
 
   // Handlers
   const handleLogout = () => {
+    const token = localStorage.getItem('agent_token');
+    if (token) {
+      axios.post(`${API}/agents/logout`, null, { params: { token } }).catch(() => {});
+    }
     localStorage.removeItem('agent_token');
     localStorage.removeItem('agent_data');
     navigate('/agent/login');
@@ -42,6 +42,7 @@ export default function VisitorChat() {
   const [newMessage, setNewMessage] = useState('');
   const [isConnected, setIsConnected] = useState(false);
   const [agentName, setAgentName] = useState(null);
+  const [queuePosition, setQueuePosition] = useState(null);
   const [isTyping, setIsTyping] = useState(false);
   const [showNameInput, setShowNameInput] = useState(true);
   const [uploading, setUploading] = useState(false);
@@ -53,6 +54,10 @@ export default function VisitorChat() {
   const messagesEndRef = useRef(null);
   const fileInputRef = useRef(null);
   const photoInputRef = useRef(null);
+  const typingTimeoutRef = useRef(null);
+  // Highest session seq seen; sent on (re)connect to receive only the gap
+  const lastSeqRef = useRef(0);
+  const closedRef = useRef(false);
 
   // Theme colors
   const bgColor = isDark ? 'bg-[#111111]' : 'bg-white';
@@ -92,7 +97,8 @@ export default function VisitorChat() {
             setShowNameInput(false);
 
             const messagesRes = await axios.get(`${API}/sessions/${storedSessionId}/messages`);
-            setMessages(messagesRes.data);
+            setMessages([...messagesRes.data.messages].reverse());
+            lastSeqRef.current = messagesRes.data.messages[0]?.seq || 0;
 
             if (session.assigned_agent_id) {
               const agentsRes = await axios.get(`${API}/agents`);
@@ -153,7 +159,8 @@ export default function VisitorChat() {
       saveSession(visitor.id, session.id, visitorName, visitorPhoto);
 
       const messagesRes = await axios.get(`${API}/sessions/${session.id}/messages`);
-      setMessages(messagesRes.data);
+      setMessages([...messagesRes.data.messages].reverse());
+      lastSeqRef.current = messagesRes.data.messages[0]?.seq || 0;
 
       connectWebSocket(session.id, visitor.id);
       
@@ -171,12 +178,44 @@ export default function VisitorChat() {
     ws.onopen = () => {
       setIsConnected(true);
       console.log('WebSocket connected');
+      ws.send(JSON.stringify({ type: 'resume', last_seq: lastSeqRef.current }));
     };
 
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      if (data.type === 'ping') {
+        ws.send(JSON.stringify({ type: 'pong' }));
+        return;
+      }
+      if (data.seq > lastSeqRef.current) lastSeqRef.current = data.seq;
       
-      if (data.type === 'new_message') {
+      if (data.type === 'resumed') {
+        // Carries the assignment too, which may have happened before this socket connected
+        if (data.agent_name) {
+          setAgentName(data.agent_name);
+          setQueuePosition(null);
+        }
+        if (data.has_more) {
+          ws.send(JSON.stringify({ type: 'resume', last_seq: lastSeqRef.current }));
+        } else if (data.session?.status === 'closed') {
+          closedRef.current = true;
+          setIsConnected(false);
+          clearStoredSession();
+        }
+      } else if ((data.type === 'rate_limited' || data.type === 'overloaded') && data.kind === 'control') {
+        // A throttled resume is simply retried; nothing has been missed for good
+        setTimeout(() => {
+          if (ws.readyState === WebSocket.OPEN) {
+            ws.send(JSON.stringify({ type: 'resume', last_seq: lastSeqRef.current }));
+          }
+        }, data.retry_after * 1000);
+      } else if (data.type === 'rate_limited' || data.type === 'overloaded') {
+        toast.error(data.type === 'rate_limited'
+          ? 'You are sending messages too quickly. Please wait a moment.'
+          : 'The chat is busy right now. Please try again shortly.');
+      } else if (data.type === 'message_failed') {
+        toast.error('Your message could not be sent. Please try again.');
+      } else if (data.type === 'new_message') {
         if (data.message.sender_type === 'agent') {
           setMessages(prev => {
             if (prev.some(m => m.id === data.message.id)) return prev;
@@ -185,13 +224,22 @@ export default function VisitorChat() {
           playNotification('agent');
         }
         setIsTyping(false);
+      } else if (data.type === 'queue_position') {
+        setQueuePosition(data.position);
       } else if (data.type === 'agent_joined') {
         setAgentName(data.agent_name);
+        setQueuePosition(null);
         toast.success(`${data.agent_name} joined the chat`);
       } else if (data.type === 'agent_typing') {
-        setIsTyping(true);
-        setTimeout(() => setIsTyping(false), 3000);
+        // The server coalesces keystrokes into start/stop transitions
+        clearTimeout(typingTimeoutRef.current);
+        setIsTyping(data.state !== 'stop');
+        if (data.state !== 'stop') {
+          // Safety net in case the stop event is lost with the connection
+          typingTimeoutRef.current = setTimeout(() => setIsTyping(false), 30000);
+        }
       } else if (data.type === 'session_closed') {
+        closedRef.current = true;
         toast.info('Chat session has been closed');
         setIsConnected(false);
         clearStoredSession();
@@ -201,6 +249,10 @@ export default function VisitorChat() {
     ws.onclose = () => {
       setIsConnected(false);
       console.log('WebSocket disconnected');
+      // Reconnect and resume from the last seen seq unless the chat is over
+      if (!closedRef.current) {
+        setTimeout(() => connectWebSocket(sid, vid), 2000);
+      }
     };
 
     ws.onerror = (error) => {
@@ -212,6 +264,7 @@ export default function VisitorChat() {
 
   useEffect(() => {
     return () => {
+      closedRef.current = true;
       if (wsRef.current) {
         wsRef.current.close();
       }
@@ -232,7 +285,7 @@ export default function VisitorChat() {
           headers: { 'Content-Type': 'multipart/form-data' }
         });
 
-        const { file_url, file_name, file_type } = res.data;
+        const { file_url, file_name, file_type, thumbnail_url, preview_url } = res.data;
         const content = newMessage.trim() || (file_type === 'image' ? 'Shared an image' : `Shared file: ${file_name}`);
 
         const messageData = {
@@ -242,7 +295,9 @@ export default function VisitorChat() {
           content,
           message_type: file_type,
           file_url,
-          file_name
+          file_name,
+          thumbnail_url,
+          preview_url
         };
 
         wsRef.current.send(JSON.stringify(messageData));
@@ -255,6 +310,8 @@ export default function VisitorChat() {
           message_type: file_type,
           file_url,
           file_name,
+          thumbnail_url,
+          preview_url,
           created_at: new Date().toISOString()
         }]);
 
@@ -356,7 +413,9 @@ export default function VisitorChat() {
                 <h1 className={`font-bold ${textColor}`}>24gameapi</h1>
                 <p className={`text-xs ${mutedText}`}>
                   {isConnected ? (
-                    agentName ? `Chatting with ${agentName}` : 'Waiting for agent...'
+                    agentName
+                      ? `Chatting with ${agentName}`
+                      : queuePosition ? `Waiting for agent... (#${queuePosition} in queue)` : 'Waiting for agent...'
                   ) : (
                     'Start a conversation'
                   )}
@@ -468,11 +527,23 @@ export default function VisitorChat() {
                         )}
                         
                         {msg.message_type === 'image' && msg.file_url && (
-                          <img
-                            src={`${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`}
-                            alt="Shared"
-                            className="rounded-lg max-w-full mb-2"
-                          />
+                          <a
+                            href={`${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`}
+                            target="_blank"
+                            rel="noopener noreferrer"
+                          >
+                            <img
+                              src={`${process.env.REACT_APP_BACKEND_URL}${msg.preview_url || msg.file_url}`}
+                              onError={(e) => {
+                                // The preview may still be rendering; show the original meanwhile
+                                const original = `${process.env.REACT_APP_BACKEND_URL}${msg.file_url}`;
+                                if (e.currentTarget.src !== original) e.currentTarget.src = original;
+                              }}
+                              loading="lazy"
+                              alt="Shared"
+                              className="rounded-lg max-w-full mb-2"
+                            />
+                          </a>
                         )}
                         
                         {msg.message_type === 'file' && msg.file_url && (